@@ -0,0 +1,171 @@
+#!/bin/env python3
+
+from contextlib import redirect_stdout
+import io
+import json
+from pathlib import Path
+from sys import stderr
+import numpy as np
+
+import finalize
+import gamma
+import montecarlo
+import mktexs
+import profiling
+import stats
+from synth import make_exam
+
+# --- Programma di valutazione verifica: ---
+# ---     Misura delle prestazioni        ---
+
+# every size of the grid gets a synthetic exam in WORKDIR, and the steps of
+# the pipeline run on it under profiling. Throughput is in results (students
+# times questions) per second, for montecarlo in results times steps. Times
+# include the tracemalloc overhead, they are meant to be compared between
+# sizes and between runs of the benchmark
+
+STUDENTS = [10, 100, 1000]
+QUESTIONS = [5, 20, 100]
+
+# shorter than the defaults, to keep the grid quick
+SETUP = {
+    "SAMPLER": "global",
+    "CHAINS": 1,
+    "THERM_LEN": 200,
+    "SIM_LEN": 1000,
+}
+
+STEPS = ["montecarlo", "stats", "gamma", "finalize", "mktexs"]
+
+# - arg checking
+
+
+def check_args(argv):
+    if len(argv) not in {2, 3, 4} or \
+            not all(size.isdigit() for arg in argv[2:] for size in arg.split(",")):
+        print(f"Usage: {argv[0]} WORKDIR [STUDENTS,... [QUESTIONS,...]]", file=stderr)
+        exit(1)
+
+
+def get_sizes(argv, i, default):
+    if len(argv) <= i:
+        return default
+    return [int(size) for size in argv[i].split(",")]
+
+# - running
+
+
+def make_bench_exam(exam_dir: Path, n_students, n_questions):
+    make_exam(exam_dir, n_students, n_questions)
+    with open(exam_dir / "simsetup.json") as inp:
+        setup = json.load(inp)
+    setup.update(SETUP)
+    with open(exam_dir / "simsetup.json", "w") as out:
+        json.dump(setup, out, indent=2)
+    return setup
+
+
+def run_steps(exam_dir: Path, setup):
+    # as the pipeline would, passing the data in memory
+    with profiling.stage("montecarlo"):
+        state = montecarlo.stage(exam_dir, True, setup=setup)
+    with profiling.stage("stats"):
+        state.update(stats.stage(exam_dir, True, setup=setup, **state))
+    with profiling.stage("gamma"):
+        # the REPL, without the interaction
+        perf_mean, worse_mean = gamma.extremal_means(state["stats"])
+        vote = gamma.Voter(state["trace"]["ps_log"], perf_mean, worse_mean,
+                           setup["MAX_VOTE"], setup["MIN_VOTE"])
+        students, _ = montecarlo.get_names(exam_dir)
+        gamma.save(exam_dir, setup["GAMMA_START"], {}, students,
+                   vote(setup["GAMMA_START"]))
+    with profiling.stage("finalize"):
+        finalize.stage(exam_dir, True)
+    with profiling.stage("mktexs"):
+        # pdflatex is not measured
+        mktexs.maketexs(exam_dir, mktexs.SCRIPT_DIR, stats=state["stats"],
+                        results=state["results"])
+
+
+def bench(work_dir: Path, students, questions):
+    work_dir.mkdir(parents=True, exist_ok=True)
+    profiling.enable()
+    rows = []
+    for n_students in students:
+        for n_questions in questions:
+            exam_dir = work_dir / f"{n_students}x{n_questions}"
+            if exam_dir.exists():
+                setup = montecarlo.get_setup(exam_dir)
+            else:
+                setup = make_bench_exam(exam_dir, n_students, n_questions)
+            print(f"Running {exam_dir.name}...")
+
+            profiling.timings.clear()
+            profiling.peaks.clear()
+            with redirect_stdout(io.StringIO()):
+                run_steps(exam_dir, setup)
+
+            for step in STEPS:
+                work = n_students * n_questions
+                if step == "montecarlo":
+                    work *= setup["THERM_LEN"] + setup["SIM_LEN"]
+                seconds = profiling.timings[step]["seconds"]
+                rows.append({
+                    "step": step,
+                    "students": n_students,
+                    "questions": n_questions,
+                    "seconds": seconds,
+                    "throughput": work / seconds,
+                    "peak_memory": profiling.peaks[step],
+                    # the steps inside, as pipeline.py --profile shows them
+                    "sections": {name: timing["seconds"] for name, timing in profiling.timings.items()
+                                 if name.startswith(f"{step}.")},
+                })
+    return rows
+
+# - trends
+
+
+def get_trends(rows):
+    # exponents of time and memory in the number of results, from a fit in
+    # log-log scale: 1 is linear scaling
+    trends = {}
+    for step in STEPS:
+        step_rows = [row for row in rows if row["step"] == step]
+        if len({row["students"] * row["questions"] for row in step_rows}) < 2:
+            continue
+        sizes = np.log([row["students"] * row["questions"]
+                       for row in step_rows])
+        trends[step] = {
+            "time_exponent": float(np.polyfit(sizes, np.log([row["seconds"] for row in step_rows]), 1)[0]),
+            "memory_exponent": float(np.polyfit(sizes, np.log([row["peak_memory"] for row in step_rows]), 1)[0]),
+        }
+    return trends
+
+
+def print_bench(rows, trends):
+    print(f"{'step':<11}{'students':>9}{'questions':>10}{'seconds':>10}{'results/s':>12}{'MiB':>9}")
+    for row in rows:
+        print(f"{row['step']:<11}{row['students']:>9}{row['questions']:>10}{row['seconds']:>10.3f}"
+              f"{row['throughput']:>12.3g}{row['peak_memory'] / 2**20:>9.1f}")
+    print()
+    print("Scaling with the number of results (1 is linear):")
+    for step, trend in trends.items():
+        print(f"    {step:<11}time {trend['time_exponent']:.2f}, memory {trend['memory_exponent']:.2f}")
+
+
+def main(argv):
+    check_args(argv)
+    work_dir = Path(argv[1])
+    rows = bench(work_dir, get_sizes(argv, 2, STUDENTS),
+                 get_sizes(argv, 3, QUESTIONS))
+    trends = get_trends(rows)
+    print_bench(rows, trends)
+    with open(work_dir / "bench.json", "w") as out:
+        json.dump({"setup": SETUP, "results": rows,
+                  "trends": trends}, out, indent=2)
+
+
+if __name__ == "__main__":
+    import sys
+    main(sys.argv)
@@ -0,0 +1,81 @@
+from functools import wraps
+import hashlib
+import json
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Union
+
+# --- Programma di valutazione verifica: ---
+# ---      Cache dei passi eseguiti      ---
+
+# every stage records in MANIFEST the content hashes of the files it read
+# and the values of the setup keys it used. When none of them changed, and
+# its outputs are still there, running it again would give the same result.
+# Stages get all of this from the cached_stage decorator
+
+MANIFEST = "manifest.json"
+
+HASH_BLOCK = 1 << 20
+
+
+def hash_file(path: Path) -> Union[str, None]:
+    if not path.is_file():
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as inp:
+        for block in iter(lambda: inp.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_manifest(work_dir: Path) -> Dict:
+    if not (work_dir / MANIFEST).exists():
+        return {}
+    with open(work_dir / MANIFEST) as inp:
+        return json.load(inp)
+
+
+def get_fingerprint(work_dir: Path, inputs: Iterable[Path], setup_keys: List[str]):
+    with open(work_dir / "simsetup.json") as inp:
+        setup = json.load(inp)
+    return {
+        "inputs": {str(path): hash_file(work_dir / path) for path in inputs},
+        "setup": {key: setup.get(key) for key in setup_keys},
+    }
+
+
+def is_fresh(work_dir: Path, stage: str, fingerprint, outputs: Iterable[Path]):
+    if not all((work_dir / path).exists() for path in outputs):
+        return False
+    return get_manifest(work_dir).get(stage) == fingerprint
+
+
+def record(work_dir: Path, stage: str, fingerprint):
+    # fingerprint is taken before running the stage, so that inputs changed
+    # in the meantime are not marked as used
+    manifest = get_manifest(work_dir)
+    manifest[stage] = fingerprint
+    with open(work_dir / MANIFEST, "w") as out:
+        json.dump(manifest, out, indent=2)
+
+
+def cached_stage(name: str, inputs: Iterable[Path], setup_keys: List[str],
+                 outputs: Union[Iterable[Path], Callable[[Path], Iterable[Path]]],
+                 extra: Callable[[Path], Dict] = None):
+    # wraps stage(work_dir, force, **state): skipped when fresh, recorded
+    # when done. outputs can depend on the work_dir, and extra adds to the
+    # fingerprint what the files and the setup keys do not hold
+    def decorator(stage):
+        @wraps(stage)
+        def wrapper(work_dir: Path, force=False, **state):
+            fingerprint = get_fingerprint(work_dir, inputs, setup_keys)
+            if extra is not None:
+                fingerprint.update(extra(work_dir))
+            expected = outputs(work_dir) if callable(outputs) else outputs
+            if not force and is_fresh(work_dir, name, fingerprint, expected):
+                print(f"{name}: nothing changed, skipping")
+                return {}
+            result = stage(work_dir, force, **state)
+            record(work_dir, name, fingerprint)
+            return result
+        return wrapper
+    return decorator
@@ -1,15 +1,24 @@
 #!/bin/env python3
 
+from bisect import bisect_left, bisect_right
+from math import sqrt
 import yaml
 import json
 from pathlib import Path
 
-from gamma import get_students
+from cache import cached_stage
+from profiling import section
 
 # ---         Programma di valutazione verifica:           ---
 # --- Preparazione del documento di valutazione definitivo ---
 
 
+def get_students(inp_dir: Path):
+    with open(inp_dir / "siminfo.json") as inp:
+        data = json.load(inp)
+    return data["students"]
+
+
 def get_comments(inp_dir: Path):
     with open(inp_dir / "comments.yml") as inp:
         return yaml.load(inp, Loader=yaml.SafeLoader)
@@ -21,34 +30,120 @@ def get_votes(inp_dir: Path, students):
     return {student: (vote, std) for student, (vote, std) in zip(students, data["votes"])}
 
 
+# two students are similar if their votes differ less than the sum in
+# quadrature of their stds. No std is bigger than the largest one, so only the
+# students within sqrt(std**2 + max_std**2) in the vote order can be similar
+
+
+class SimilarityIndex:
+    def __init__(self, votes):
+        self.votes = votes
+        self.students = list(votes)
+        # students by vote
+        self.order = sorted(range(len(self.students)),
+                            key=lambda i: votes[self.students[i]][0])
+        self.sorted_votes = [votes[self.students[i]][0] for i in self.order]
+        self.max_std = max((std for _, std in votes.values()), default=0)
+        # answers already given, clusters ask them again
+        self.found = {}
+
+    def similar(self, student):
+        if student in self.found:
+            return self.found[student]
+        vote, std = self.votes[student]
+        # slightly wider, against rounding on the border
+        radius = sqrt(std**2 + self.max_std**2) * (1 + 1e-9)
+        start = bisect_left(self.sorted_votes, vote - radius)
+        stop = bisect_right(self.sorted_votes, vote + radius)
+        found = []
+        for i in self.order[start:stop]:
+            other_vote, other_std = self.votes[self.students[i]]
+            if abs(vote - other_vote)**2 < std**2 + other_std**2:
+                found.append(i)
+        # in the order of the students
+        self.found[student] = [self.students[i] for i in sorted(found)]
+        return self.found[student]
+
+    def clusters(self):
+        # groups of students linked by a chain of similar ones
+        parents = list(range(len(self.students)))
+
+        def root(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        index = {student: i for i, student in enumerate(self.students)}
+        for i, student in enumerate(self.students):
+            for other in self.similar(student):
+                parents[root(index[other])] = root(i)
+
+        groups = {}
+        for i, student in enumerate(self.students):
+            groups.setdefault(root(i), []).append(student)
+        return list(groups.values())
+
+
 def find_similar(student, votes):
-    vote, std = votes[student]
-    return [other_student for other_student, (other_vote, other_std) in votes.items() if (abs(vote - other_vote)**2 < std**2 + other_std**2)]
+    return SimilarityIndex(votes).similar(student)
 
 
-def get_finalizing_struct(inp_dir: Path):
+def get_finalizing_struct(inp_dir: Path, students=None, index=None):
     comments = get_comments(inp_dir)
-    students = get_students(inp_dir)
+    if students is None:
+        students = get_students(inp_dir)
     votes = get_votes(inp_dir, students)
+    if index is None:
+        index = SimilarityIndex(votes)
     return {
         student: {
             "comment": comments[student],
             "suggested vote": f"{votes[student][0]} +- {votes[student][1]}",
-            "similar votes": find_similar(student, votes),
+            "similar votes": index.similar(student),
             "final_vote": None
         }
         for student in students
     }
 
 
-def main(argv):
-    work_dir = Path(argv[1])
-    finalizing_struct = get_finalizing_struct(work_dir)
-    with open(work_dir / "final.yml", "w") as out:
-        yaml.dump(finalizing_struct, out,
-                  Dumper=yaml.SafeDumper, sort_keys=False)
+def print_clusters(index: SimilarityIndex):
+    clusters = [cluster for cluster in index.clusters() if len(cluster) > 1]
+    if not clusters:
+        return
+    print("Students with indistinguishable votes:")
+    for cluster in clusters:
+        print(f"    {', '.join(cluster)}")
+
+
+# - stage caching
+
+# final.yml gets edited by hand, skipping also keeps those edits safe
+CACHE_INPUTS = ["comments.yml", "siminfo.json", "votes.json"]
+CACHE_SETUP = []
+CACHE_OUTPUTS = ["final.yml"]
+
+
+@cached_stage("finalize", CACHE_INPUTS, CACHE_SETUP, CACHE_OUTPUTS)
+def stage(work_dir: Path, force=False, info=None, **state):
+    students = get_students(work_dir) if info is None else info["students"]
+    with section("finalize.similar"):
+        index = SimilarityIndex(get_votes(work_dir, students))
+        finalizing_struct = get_finalizing_struct(work_dir, students, index)
+    with section("finalize.yaml"):
+        with open(work_dir / "final.yml", "w") as out:
+            yaml.dump(finalizing_struct, out,
+                      Dumper=yaml.SafeDumper, sort_keys=False)
+
+    print_clusters(index)
+    return {}
+
+
+def main(argv, force=False):
+    stage(Path(argv[1]), force)
 
 
 if __name__ == "__main__":
     import sys
-    main(sys.argv)
+    main([arg for arg in sys.argv if arg != "--force"],
+         force="--force" in sys.argv)
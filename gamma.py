@@ -1,38 +1,57 @@
 #!/bin/env python3
 
+from collections import OrderedDict
 import cmd
 import json
 from operator import le
 from typing import IO, Dict, Union
 import yaml
 from pathlib import Path
+import sys
+from sys import stderr
 import numpy as np
 import readline
 from init import normalize_name
 
-from stats import get_arrays
+from stats import CHUNK_ROWS, get_log
 
 # --- Programma di valutazione verifica: ---
 # ---            gamma REPL              ---
 
+# - arg checking
+
+
+def check_args(argv):
+    # WORKDIR alone opens the REPL
+    if len(argv) == 2 or (len(argv) == 5 and argv[2] == "fit"):
+        return
+    print(f"Usage: {argv[0]} WORKDIR [fit mean|median|pass TARGET]", file=stderr)
+    sys.exit(1)
+
 # - load data
 
 
 def get_ps_log(inp_dir: Path):
-    ps_log, _, _, _ = get_arrays(inp_dir)
-    return ps_log
+    # only the scores: the other logs are not even opened
+    return get_log(inp_dir, "ps_log")
+
+
+def setup_values(data):
+    return data["MAX_VOTE"], data["MIN_VOTE"], data["GAMMA_START"], data.get("PASS_VOTE", 6)
 
 
 def get_setup(inp_dir: Path):
     with open(inp_dir / "simsetup.json") as inp:
-        data = json.load(inp)
-    return data["MAX_VOTE"], data["MIN_VOTE"], data["GAMMA_START"]
+        return setup_values(json.load(inp))
+
+
+def extremal_means(data):
+    return data["perfect_score"][0], data["worse_score"][0]
 
 
 def get_extremal_means(inp_dir: Path):
     with open(inp_dir / "stats.json") as inp:
-        data = json.load(inp)
-    return data["perfect_score"][0], data["worse_score"][0]
+        return extremal_means(json.load(inp))
 
 
 def get_students(inp_dir: Path):
@@ -65,25 +84,106 @@ def clamp(x):
     return x
 
 
-def vote(gamma, ps_log, perf_mean, worse_mean, MAX_VOTE, MIN_VOTE):
-    votes = (
-        clamp((ps_log - worse_mean) / (perf_mean - worse_mean))**gamma
-        * (MAX_VOTE - MIN_VOTE) + MIN_VOTE
-    )
-    return votes.mean(axis=0), votes.std(axis=0)
+# the votes are MIN_VOTE + (MAX_VOTE - MIN_VOTE) * x**gamma, with x the score
+# normalized between the worse and the perfect scorer. x does not depend on
+# gamma, so it is computed once, and mean and std of the votes are the ones
+# of x**gamma, scaled. The last VOTE_CACHE gammas are remembered
+
+VOTE_CACHE = 16
+
+
+class Voter:
+    def __init__(self, ps_log, perf_mean, worse_mean, MAX_VOTE, MIN_VOTE):
+        self.MAX_VOTE = MAX_VOTE
+        self.MIN_VOTE = MIN_VOTE
+        # normalized scores, filled a chunk at a time
+        self.xs = np.empty(ps_log.shape)
+        for start in range(0, ps_log.shape[0], CHUNK_ROWS):
+            xs = self.xs[start:start+CHUNK_ROWS]
+            np.subtract(ps_log[start:start+CHUNK_ROWS], worse_mean, out=xs)
+            xs /= perf_mean - worse_mean
+            clamp(xs)
+        self.buffer = np.empty_like(self.xs)
+        self.cache = OrderedDict()
+
+    def __call__(self, gamma):
+        if gamma in self.cache:
+            self.cache.move_to_end(gamma)
+            return self.cache[gamma]
+
+        powers = np.power(self.xs, gamma, out=self.buffer)
+        mean = powers.mean(axis=0)
+        # the deviations overwrite the powers
+        powers -= mean
+        np.square(powers, out=powers)
+        std = np.sqrt(powers.mean(axis=0))
+
+        votes = (mean * (self.MAX_VOTE - self.MIN_VOTE) + self.MIN_VOTE,
+                 std * (self.MAX_VOTE - self.MIN_VOTE))
+        self.cache[gamma] = votes
+        if len(self.cache) > VOTE_CACHE:
+            self.cache.popitem(last=False)
+        return votes
+
+    def means(self, gammas):
+        # mean vote of every student, for many gammas at once. The trace is
+        # read in chunks, so that the powers fit in FIT_BUFFER numbers
+        rows = max(1, FIT_BUFFER // (len(gammas) * self.xs.shape[1]))
+        sums = np.zeros((len(gammas), self.xs.shape[1]))
+        for start in range(0, self.xs.shape[0], rows):
+            sums += np.power(self.xs[np.newaxis, start:start+rows],
+                             gammas[:, np.newaxis, np.newaxis]).sum(axis=1)
+        return sums / self.xs.shape[0] * (self.MAX_VOTE - self.MIN_VOTE) + self.MIN_VOTE
+
+# - fitting
+
+# the votes decrease with gamma, and so do their mean, their median and the
+# fraction of students passing. The fit evaluates FIT_CANDIDATES gammas spread
+# over the bracket, and keeps the interval where the statistic crosses the
+# target, until it is FIT_TOLERANCE wide (relative)
+
+
+FIT_CANDIDATES = 16
+FIT_TOLERANCE = 1e-4
+FIT_BUFFER = 1 << 22
+GAMMA_RANGE = (1e-2, 1e2)
+
+
+def get_fit_statistics(PASS_VOTE):
+    # class statistic of the students' mean votes, one for each gamma
+    return {
+        "mean": lambda means: means.mean(axis=1),
+        "median": lambda means: np.median(means, axis=1),
+        "pass": lambda means: (means >= PASS_VOTE).mean(axis=1),
+    }
+
+
+def fit_gamma(voter: Voter, statistic, target):
+    low, high = GAMMA_RANGE
+    values = statistic(voter.means(np.array(GAMMA_RANGE)))
+    if not values[1] < target <= values[0]:
+        raise ValueError(
+            f"Target {target} is out of reach, gammas in {GAMMA_RANGE} give {values[1]:.4} to {values[0]:.4}")
+    while high / low > 1 + FIT_TOLERANCE:
+        gammas = np.geomspace(low, high, FIT_CANDIDATES)
+        reached = np.count_nonzero(statistic(voter.means(gammas)) >= target)
+        i = min(max(reached - 1, 0), FIT_CANDIDATES - 2)
+        low, high = gammas[i], gammas[i+1]
+    # the biggest gamma still reaching the target
+    return float(low)
 
 
 def cls():
     print("\033[H\033[J", end="")
 
 
-def print_table(gamma, vote_args, students, comments):
+def print_table(gamma, votes, students, comments):
     name_len = max(len(name) for name in students)
     print(f"Gamma: {gamma}")
     print()
     print("\n".join(f"{name.ljust(name_len)}: {vote_mean:4.2} +- {vote_std:4.2}"
                     + (f" -> {comments[name]}" if name in comments else "")
-                    for name, vote_mean, vote_std in zip(students, *vote(gamma, *vote_args))))
+                    for name, vote_mean, vote_std in zip(students, *votes)))
 
 
 def save(out_dir, gamma, comments: Dict[str, str], students, votes):
@@ -107,8 +207,12 @@ class CommandLine(cmd.Cmd):
     intro = 'Welcome to the gamma edit.\nType help or ? to list commands.\n'
     prompt = '> '
 
-    def __init__(self, work_dir: Path, completekey: str = None, stdin: Union[IO[str], None] = None, stdout: Union[IO[str], None] = None) -> None:
+    def __init__(self, work_dir: Path, completekey: str = None, stdin: Union[IO[str], None] = None, stdout: Union[IO[str], None] = None,
+                 ps_log=None, setup=None, stats=None, info=None) -> None:
         self.work_dir: Path = work_dir
+        # data already in memory, the rest is loaded from work_dir
+        self.preloaded = dict(ps_log=ps_log, setup=setup,
+                              stats=stats, info=info)
         super().__init__(completekey, stdin, stdout)
 
     @property
@@ -123,12 +227,17 @@ class CommandLine(cmd.Cmd):
 
     def preloop(self) -> None:
         """Load the needed data"""
-        self.ps_log = get_ps_log(self.work_dir)
-        self.MAX_VOTE, self.MIN_VOTE, self.GAMMA_START = get_setup(
-            self.work_dir)
-        self.perf_mean, self.worse_mean = get_extremal_means(self.work_dir)
-        self.students = get_students(self.work_dir)
-        self.vote_args = self.ps_log, self.perf_mean, self.worse_mean, self.MAX_VOTE, self.MIN_VOTE
+        preloaded = self.preloaded
+        self.ps_log = get_ps_log(self.work_dir) \
+            if preloaded["ps_log"] is None else preloaded["ps_log"]
+        self.MAX_VOTE, self.MIN_VOTE, self.GAMMA_START, self.PASS_VOTE = get_setup(self.work_dir) \
+            if preloaded["setup"] is None else setup_values(preloaded["setup"])
+        self.perf_mean, self.worse_mean = get_extremal_means(self.work_dir) \
+            if preloaded["stats"] is None else extremal_means(preloaded["stats"])
+        self.students = get_students(self.work_dir) \
+            if preloaded["info"] is None else preloaded["info"]["students"]
+        self.vote = Voter(self.ps_log, self.perf_mean,
+                          self.worse_mean, self.MAX_VOTE, self.MIN_VOTE)
 
         self.gamma = get_gamma(self.work_dir, self.GAMMA_START)
         self.comments = get_comments(self.work_dir)
@@ -141,7 +250,7 @@ class CommandLine(cmd.Cmd):
 
     def do_table(self, arg: str = None):
         "Print the vote table"
-        print_table(self.gamma, self.vote_args,
+        print_table(self.gamma, self.vote(self.gamma),
                     self.students, self.comments)
 
     def do_comment(self, arg: str):
@@ -177,11 +286,31 @@ class CommandLine(cmd.Cmd):
         else:
             self.do_table()
 
+    def fit(self, arg: str):
+        statistics = get_fit_statistics(self.PASS_VOTE)
+        try:
+            name, target = arg.split()
+            statistic = statistics[name]
+            target = float(target)
+        except (ValueError, KeyError):
+            raise ValueError(
+                f"Expected fit {'|'.join(statistics)} TARGET, got fit {arg}") from None
+        self.gamma = fit_gamma(self.vote, statistic, target)
+
+    def do_fit(self, arg: str):
+        "Find the gamma giving a class mean or median vote, or a pass rate: fit mean|median|pass TARGET"
+        try:
+            self.fit(arg)
+        except ValueError as e:
+            print(e)
+        else:
+            self.do_table()
+
     def do_save(self, arg: str = None):
         "Save the gamma and comments"
         if self.saved_hash != self.content_hash:
             save(self.work_dir, self.gamma, self.comments,
-                 self.students, vote(self.gamma, *self.vote_args))
+                 self.students, self.vote(self.gamma))
             self.saved_hash = self.content_hash
 
     def do_quit(self, arg: str = None):
@@ -206,6 +335,34 @@ def repl(work_dir: Path):
     CommandLine(work_dir).cmdloop()
 
 
+def fit(work_dir: Path, arg: str):
+    # non interactive: fit gamma, then save as the REPL would
+    cmdline = CommandLine(work_dir)
+    cmdline.preloop()
+    try:
+        cmdline.fit(arg)
+    except ValueError as e:
+        print(e, file=stderr)
+        sys.exit(1)
+    print(f"Gamma: {cmdline.gamma}")
+    save(work_dir, cmdline.gamma, cmdline.comments,
+         cmdline.students, cmdline.vote(cmdline.gamma))
+
+
+def stage(work_dir: Path, force=False, trace=None, setup=None, stats=None, info=None, **state):
+    # interactive, so it always runs
+    CommandLine(
+        work_dir,
+        ps_log=None if trace is None else trace["ps_log"],
+        setup=setup, stats=stats, info=info
+    ).cmdloop()
+    return {}
+
+
 if __name__ == "__main__":
-    import sys
-    repl(Path(sys.argv[1]))
+    check_args(sys.argv)
+    if len(sys.argv) > 2:
+        # the fit subcommand, as typed in the REPL
+        fit(Path(sys.argv[1]), " ".join(sys.argv[3:]))
+    else:
+        repl(Path(sys.argv[1]))
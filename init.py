@@ -14,12 +14,34 @@ import yaml
 DEFAULTS = {
     # - montecarlo
     "SEED": 35,
+    "SAMPLER": "global",  # or "sweep", "batched", "hmc"
+    "CHAINS": 1,
+    "WORKERS": None,  # defaults to the number of cpus
+    "TRACE": "npz",  # or "memmap", to stream the trace to disk
+    # keep running means and covariances of every step while sampling. It
+    # saves no memory and little time: the trace is still stored and read
+    # whole by stats (autocorrelations, extremal scores) and by gamma. Only
+    # the mean and covariance pass is skipped, paid for with an update of
+    # S x S matrices at every step. Worth it only to summarize every step
+    # of a thinned or float16 trace
+    "ACCUMULATE": False,
 
     "DELTA": 0.25,
     "ALPHADELTA": 1,
+    # tune DELTA and ALPHADELTA during the thermalization
+    "ADAPT": True,
+    "TARGET_ACCEPT": None,  # defaults to the optimum for the sampler
 
     "THERM_LEN": 1000,
     "SIM_LEN": 10000,
+    # log one step every THIN, with TRACE_DTYPE ("float64", "float32" or
+    # "float16"). COMPRESS compresses montecarlo.npz, not the memmap trace
+    "THIN": 1,
+    "TRACE_DTYPE": "float64",
+    "COMPRESS": False,
+    # restart from the previous run, sweeping the changed results for RETHERM_LEN steps
+    "WARM_START": False,
+    "RETHERM_LEN": 200,
 
     # - stats
     "PERFECT_SCORER_PTS": 100,
@@ -28,9 +50,22 @@ DEFAULTS = {
     "GAMMA_START": 1,
     "MIN_VOTE": 1,
     "MAX_VOTE": 10,
+    "PASS_VOTE": 6,  # for fit pass
 
     # - report
-    "CORRS_WARN_THRESHOLD": 2.
+    "CORRS_WARN_THRESHOLD": 2.,
+    "RHAT_WARN_THRESHOLD": 1.01,
+    "ESS_WORST": 5,
+
+    # - pdf reports
+    "TEX_JOBS": None,  # defaults to the number of cpus
+    "TEX_TIMEOUT": 120,  # seconds for a single pdflatex run
+    # dump the common preamble in a format, loaded by every report
+    "TEX_PRECOMPILE": False,
+    # build all the reports as one document, then split it with qpdf
+    "TEX_BATCH": False,
+    # a new evaluation date alone rebuilds all the reports
+    "TEX_NEW_DATE": False
 }
 
 # - arg checking
@@ -1,6 +1,7 @@
 #!/bin/env python3
 
 from datetime import date
+import hashlib
 import json
 from pathlib import Path
 import re
@@ -8,11 +9,14 @@ from statistics import mean, variance
 import unicodedata
 from warnings import warn
 import yaml
-from typing import Dict, List, Tuple
-from os import chdir
-from subprocess import Popen, DEVNULL
+from typing import Dict, Iterator, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+from subprocess import run, DEVNULL, TimeoutExpired
 from shutil import copyfile
 
+from cache import cached_stage
+from profiling import section, timed
 from montecarlo import get_results
 
 # --- Programma di valutazione verifica: ---
@@ -20,6 +24,34 @@ from montecarlo import get_results
 
 
 LATEX_COMMAND = "pdflatex"
+LATEX_OPTIONS = ["-interaction=nonstopmode", "-halt-on-error"]
+
+# pdflatex is run again while the log asks for it, up to LATEX_MAX_RUNS times
+LATEX_RERUN = re.compile(r"Rerun to get|Label\(s\) may have changed")
+LATEX_MAX_RUNS = 3
+
+# lines of the log shown for a failed build
+LOG_EXCERPT = 10
+
+# the static part of the preamble, the same for all the reports, can be dumped
+# in a format with mylatexformat. Each report then starts from the format, and
+# skips its own preamble up to \endofdump
+FORMAT_NAME = "preamble"
+
+# the reports can also be built as a single document, each one in a group
+# ending with its last page, and split back with qpdf
+BATCH_NAME = "reports"
+SPLIT_COMMAND = "qpdf"
+
+# hashes of the rendered sources, to rebuild only the changed reports. The
+# evaluation date is left out, unless TEX_NEW_DATE is set. A hash is saved
+# only once the pdf of its source is built
+SOURCE_HASHES = "hashes.json"
+
+EVALUATION_DATE = "%d/%m/%Y"
+
+TEX_BEGIN = "\\begin{document}"
+TEX_END = "\\end{document}"
 
 
 def get_infos(inp_dir: Path):
@@ -35,10 +67,11 @@ def get_votes_and_comments(inp_dir: Path):
     return {name: data[name]["final_vote"] for name in data}, {name: data[name]["comment"]["long"] for name in data}
 
 
-def get_difficulties(inp_dir: Path, questions: List[str]) -> List[Tuple[str, str]]:
-    with open(inp_dir / "stats.json") as inp:
-        data = json.load(inp)
-    difficulties = [difficulty for difficulty, _ in data["difficulties"]]
+def get_difficulties(inp_dir: Path, questions: List[str], stats=None) -> List[Tuple[str, str]]:
+    if stats is None:
+        with open(inp_dir / "stats.json") as inp:
+            stats = json.load(inp)
+    difficulties = [difficulty for difficulty, _ in stats["difficulties"]]
     diff_mean, diff_std = mean(difficulties), variance(difficulties)
     low_bar = diff_mean - 2*diff_std
     high_bar = diff_mean + 2*diff_std
@@ -71,14 +104,25 @@ def format_result(result):
     return '\\cmark' if result > 0 else '\\xmark'
 
 
-def get_tex_subs(inp_dir) -> Dict[str, Dict[str, str]]:
-    test_data, students, questions = get_infos(inp_dir)
-    votes, comments = get_votes_and_comments(inp_dir)
-    questions = get_difficulties(inp_dir, questions)
-    results = get_results(inp_dir)
+def get_evaluation_date() -> str:
+    return date.today().strftime(EVALUATION_DATE)
 
-    return {
-        student: {
+
+def get_tex_subs(inp_dir, info=None, stats=None, results=None) -> Iterator[Tuple[str, Dict[str, str]]]:
+    # info, stats and results are read from inp_dir, unless already in memory
+    if info is None:
+        test_data, students, questions = get_infos(inp_dir)
+    else:
+        test_data, students, questions = info["test"], info["students"], info["questions"]
+    votes, comments = get_votes_and_comments(inp_dir)
+    questions = get_difficulties(inp_dir, questions, stats)
+    if results is None:
+        results = get_results(inp_dir)
+
+    # one student at a time, the reports are written as they are made
+    evaluation_date = get_evaluation_date()
+    for i, student in enumerate(students):
+        yield student, {
             "@TestName@": test_data["name"],
             "@Class@": test_data["class"],
             "@TestDate@": test_data["date"],
@@ -94,11 +138,13 @@ def get_tex_subs(inp_dir) -> Dict[str, Dict[str, str]]:
                 for (question, difficulty), result in zip(questions, results[i])
             ),
 
-            "@EvaluationDate@": date.today().strftime("%d/%m/%Y"),
+            "@EvaluationDate@": evaluation_date,
         }
 
-        for i, student in enumerate(students)
-    }
+
+def get_setup(inp_dir: Path):
+    with open(inp_dir / "simsetup.json") as inp:
+        return json.load(inp)
 
 
 def get_tex_stub(script_dir) -> str:
@@ -106,10 +152,38 @@ def get_tex_stub(script_dir) -> str:
         return inp.read()
 
 
-def replace_all(string: str, subs: Dict[str, str]) -> str:
-    for initial, final in subs.items():
-        string = string.replace(initial, final)
-    return string
+# the stub is split once in literal text and @Placeholders@, at the odd
+# positions. A report is the join of the segments, with the placeholders
+# substituted in a single pass
+
+PLACEHOLDER = re.compile(r"(@\w+@)")
+
+
+def compile_template(stub: str) -> List[str]:
+    return PLACEHOLDER.split(stub)
+
+
+def check_placeholders(template: List[str], subs: Dict[str, str]):
+    placeholders = set(template[1::2])
+    for name in sorted(placeholders - subs.keys()):
+        warn(f"Unknown placeholder {name} in the stub, it is left as it is")
+    for name in sorted(subs.keys() - placeholders):
+        warn(f"Placeholder {name} is not used in the stub")
+
+
+def get_static_preamble(template: List[str]) -> str:
+    # the lines before the first placeholder, inside the preamble
+    head = template[0]
+    if TEX_BEGIN in head:
+        head = head[:head.index(TEX_BEGIN)]
+    return head[:head.rfind("\n") + 1]
+
+
+def render(template: List[str], subs: Dict[str, str]) -> str:
+    segments = template.copy()
+    for i in range(1, len(segments), 2):
+        segments[i] = subs.get(segments[i], segments[i])
+    return "".join(segments)
 
 
 def slugify(value, allow_unicode=False):
@@ -130,89 +204,304 @@ def slugify(value, allow_unicode=False):
     return re.sub(r'[-\s]+', '-', value).strip('-_')
 
 
-def save(out_dir: Path, texs: Dict[str, str]):
-    texs_path = out_dir / "texs" / "sources"
-    texs_path.mkdir(parents=True, exist_ok=True)
-    for student, tex in texs.items():
-        with open((texs_path / slugify(student)).with_suffix(".tex"), "w") as out:
-            out.write(tex)
+def get_source_hashes(texs_path: Path) -> Dict[str, str]:
+    if not (texs_path / SOURCE_HASHES).exists():
+        return {}
+    with open(texs_path / SOURCE_HASHES) as inp:
+        return json.load(inp)
 
 
-def maketexs(argv):
-    work_dir = Path(argv[1])
-    subs = get_tex_subs(work_dir)
-    stub = get_tex_stub(Path(argv[0]).parent)
-    texs = {
-        student: replace_all(stub, sub)
-        for student, sub in subs.items()
-    }
-    save(work_dir, texs)
+def save_source_hashes(texs_path: Path, hashes: Dict[str, str]):
+    with open(texs_path / SOURCE_HASHES, "w") as out:
+        json.dump(hashes, out, indent=2)
 
 
-class Chdir:
-    def __init__(self, dir_name):
-        self.dir_name = dir_name
+def save(texs_path: Path, student: str, tex: str):
+    with open((texs_path / slugify(student)).with_suffix(".tex"), "w") as out:
+        out.write(tex)
 
-    def __enter__(self):
-        self.original_dir = Path.cwd()
-        chdir(self.dir_name)
-        return self.dir_name
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        chdir(self.original_dir)
-
-
-def runtex(work_dir: Path):
+def maketexs(work_dir: Path, script_dir: Path, info=None, stats=None, results=None, TEX_NEW_DATE=False):
+    # returns the names of the sources that changed, and the hashes of all
+    template = compile_template(get_tex_stub(script_dir))
+    texs_path = work_dir / "texs" / "sources"
+    texs_path.mkdir(parents=True, exist_ok=True)
+    old_hashes = get_source_hashes(work_dir / "texs")
+    hashes = {}
+    changed = set()
+    for i, (student, subs) in enumerate(get_tex_subs(work_dir, info, stats, results)):
+        if i == 0:
+            # placeholders are the same for everyone
+            check_placeholders(template, subs)
+        tex = render(template, subs)
+        name = f"{slugify(student)}.tex"
+        hashes[name] = hashlib.sha256(
+            (tex if TEX_NEW_DATE else render(template, dict(subs, **{"@EvaluationDate@": ""})))
+            .encode()
+        ).hexdigest()
+        # unchanged sources keep their date, as their pdf
+        if hashes[name] != old_hashes.get(name) or not (texs_path / name).exists():
+            save(texs_path, student, tex)
+            changed.add(name)
+    return changed, hashes
+
+
+def log_excerpt(log_file: Path) -> str:
+    # the errors with their context, or the end of the log
+    if not log_file.exists():
+        return "no log was written"
+    with open(log_file, errors="replace") as inp:
+        lines = inp.read().splitlines()
+    errors = [i for i, line in enumerate(lines) if line.startswith("!")]
+    if not errors:
+        return "\n".join(lines[-LOG_EXCERPT:])
+    start = errors[0]
+    return "\n".join(lines[start:start+LOG_EXCERPT])
+
+
+def compile_tex(tex_file: Path, TEX_TIMEOUT, options=(), env=None, suffix=".pdf"):
+    # runs in a worker thread, in the directory of tex_file. Returns None or
+    # the reason of the failure
+    log_file = tex_file.with_suffix(".log")
+    for _ in range(LATEX_MAX_RUNS):
+        try:
+            process = run(
+                [LATEX_COMMAND, *LATEX_OPTIONS, *options, tex_file.name],
+                cwd=tex_file.parent,
+                stdin=DEVNULL,
+                stdout=DEVNULL,
+                timeout=TEX_TIMEOUT,
+                env=env
+            )
+        except TimeoutExpired:
+            return f"timed out after {TEX_TIMEOUT} s\n{log_excerpt(log_file)}"
+        if process.returncode != 0:
+            return f"exited with code {process.returncode}\n{log_excerpt(log_file)}"
+        with open(log_file, errors="replace") as inp:
+            if not LATEX_RERUN.search(inp.read()):
+                break
+    if not tex_file.with_suffix(suffix).exists():
+        return f"no {suffix} was generated\n{log_excerpt(log_file)}"
+    return None
+
+
+def make_format(run_dir: Path, preamble: str, TEX_TIMEOUT):
+    # returns the options and the environment to build from the format, or
+    # None if it could not be made
+    tex_file = run_dir / f"{FORMAT_NAME}.tex"
+    with open(tex_file, "w") as out:
+        out.write(f"{preamble}{TEX_BEGIN}\n{TEX_END}\n")
+    failure = compile_tex(
+        tex_file, TEX_TIMEOUT,
+        ["-ini", f"-jobname={FORMAT_NAME}", f"&{LATEX_COMMAND}", "mylatexformat.ltx"],
+        suffix=".fmt"
+    )
+    if failure is not None:
+        print(f"The preamble could not be precompiled, building without it: {failure}")
+        return None
+    # an empty entry in TEXFORMATS stands for the default path
+    env = dict(os.environ, TEXFORMATS=f"{run_dir.resolve()}{os.pathsep}")
+    return [f"-fmt={FORMAT_NAME}"], env
+
+
+def dump_preamble(source: str, preamble: str) -> str:
+    # with the format loaded, what comes before \endofdump is skipped
+    return f"{preamble}\\endofdump\n{source[len(preamble):]}"
+
+
+def build_batch(sources: Dict[Path, str], run_dir: Path, out_dir: Path, preamble: str, TEX_TIMEOUT,
+                formatted=None) -> Dict[Path, str]:
+    # all the reports in one document, every one in a group with its own
+    # definitions. The last page of each one is written to BATCH_NAME.pages.
+    # Returns the reports that could not be collected, with the reason
+    batch_dir = run_dir / BATCH_NAME
+    batch_dir.mkdir(exist_ok=True)
+    tex_file = batch_dir / f"{BATCH_NAME}.tex"
+    with open(tex_file, "w") as out:
+        out.write(preamble)
+        if formatted is not None:
+            out.write("\\endofdump\n")
+        out.write(f"{TEX_BEGIN}\n"
+                  "\\newwrite\\reportpages\n"
+                  "\\immediate\\openout\\reportpages=\\jobname.pages\n")
+        for source in sources.values():
+            begin = source.index(TEX_BEGIN)
+            out.write("\\begingroup\n")
+            out.write(source[len(preamble):begin])
+            out.write(source[begin + len(TEX_BEGIN):source.rindex(TEX_END)])
+            out.write("\\clearpage\n"
+                      "\\immediate\\write\\reportpages{\\the\\numexpr\\value{page}-1\\relax}\n"
+                      "\\endgroup\n")
+        out.write(f"\\immediate\\closeout\\reportpages\n{TEX_END}\n")
+
+    failure = compile_tex(tex_file, TEX_TIMEOUT * len(sources), *(formatted or ()))
+    if failure is not None:
+        return dict.fromkeys(sources, f"the batch build {failure}")
+
+    # splitting
+    with open(batch_dir / f"{BATCH_NAME}.pages") as inp:
+        last_pages = [int(line) for line in inp]
+    failures = {}
+    first_page = 1
+    for i, (file, last_page) in enumerate(zip(sources, last_pages)):
+        try:
+            process = run(
+                [SPLIT_COMMAND, "--empty", "--pages", tex_file.with_suffix(".pdf").name,
+                 f"{first_page}-{last_page}", "--", (out_dir / file.name).with_suffix(".pdf").resolve()],
+                cwd=batch_dir,
+                stdin=DEVNULL,
+                stdout=DEVNULL
+            )
+        except FileNotFoundError:
+            # none of the rest can be split either
+            failures.update(dict.fromkeys(
+                list(sources)[i:], f"{SPLIT_COMMAND} is needed to split the batch"))
+            break
+        if process.returncode != 0:
+            failures[file] = f"{SPLIT_COMMAND} exited with code {process.returncode}"
+        else:
+            print(f"Collecting {file.with_suffix('.pdf').name}")
+        first_page = last_page + 1
+    # reports missing from the pages file were not closed in the batch
+    failures.update(dict.fromkeys(
+        list(sources)[len(last_pages):], "missing from the batch"))
+    return failures
+
+
+def runtex(work_dir: Path, TEX_JOBS=None, TEX_TIMEOUT=120, TEX_PRECOMPILE=False, TEX_BATCH=False,
+           preamble="", changed=None, **kwargs):
+    # only the sources named in changed are built, with the ones missing
+    # their pdf. All of them if changed is None
     work_dir = work_dir / "texs"
 
-    sources = (work_dir / "sources").glob("*.tex")
     run_dir = work_dir / "build"
     out_dir = work_dir / "output"
 
     run_dir.mkdir(exist_ok=True)
     out_dir.mkdir(exist_ok=True)
 
-    tex_processes: List[Tuple[Path, Popen]] = []
-
-    # starting tex engines...
-    for file in sources:
-        print(f"Running {LATEX_COMMAND} on {file.name}...")
-        local_dir = run_dir / file.stem
-        local_dir.mkdir(exist_ok=True)
-        copyfile(file, local_dir / file.name)
-
-        with Chdir(local_dir):
-            tex_processes.append(
-                (
-                    file,
-                    local_dir,
-                    Popen([
-                        LATEX_COMMAND,
-                        file.name
-                    ],
-                        stdin=DEVNULL,
-                        stdout=DEVNULL
-                    )
-                )
-            )
+    sources = {}
+    files = sorted((work_dir / "sources").glob("*.tex"))
+    for file in files:
+        if changed is not None and file.name not in changed \
+                and (out_dir / file.name).with_suffix(".pdf").exists():
+            continue
+        with open(file) as inp:
+            sources[file] = inp.read()
+
+    total = len(sources)
+    failures = {}
+    if total < len(files):
+        print(f"Building {total} of {len(files)} reports, the others did not change")
+
+    # reports edited by hand could have a different preamble, they are
+    # built alone and without the format
+    standard = {file: source for file, source in sources.items()
+                if preamble and source.startswith(preamble)}
+
+    formatted = None
+    if TEX_PRECOMPILE and standard:
+        with section("mktexs.format"):
+            formatted = make_format(run_dir, preamble, TEX_TIMEOUT)
+
+    if TEX_BATCH and standard:
+        with section("mktexs.batch"):
+            batch_failures = build_batch(
+                standard, run_dir, out_dir, preamble, TEX_TIMEOUT, formatted)
+        # what the batch could not give is built one report at a time
+        for reason in sorted(set(batch_failures.values())):
+            files = [file for file, failure in batch_failures.items() if failure == reason]
+            print(f"{len(files)} reports are built alone, as {reason}")
+        sources = {file: source for file, source in sources.items()
+                   if file not in standard or file in batch_failures}
+
+    # every build runs in its own directory, at most TEX_JOBS at a time
+    # (default: the number of cpus)
+    with ThreadPoolExecutor(max_workers=TEX_JOBS or os.cpu_count()) as executor:
+        jobs = []
+        for file, source in sources.items():
+            local_dir = run_dir / file.stem
+            local_dir.mkdir(exist_ok=True)
+            options, env = (), None
+            if formatted is not None and file in standard:
+                options, env = formatted
+                source = dump_preamble(source, preamble)
+            with open(local_dir / file.name, "w") as out:
+                out.write(source)
+            jobs.append((file, local_dir, executor.submit(
+                timed("mktexs.tex_job", compile_tex), local_dir / file.name, TEX_TIMEOUT, options, env)))
+
+        # collecting results
+        for file, local_dir, job in jobs:
+            failure = job.result()
+            if failure is not None:
+                failures[file.name] = failure
+                # an old pdf would not match its source anymore
+                (out_dir / file.name).with_suffix(".pdf").unlink(missing_ok=True)
+                continue
+            print(f"Collecting {file.with_suffix('.pdf').name}")
+            out_file = (local_dir / file.name).with_suffix('.pdf')
+            copyfile(out_file, out_dir / out_file.name)
 
-    # collecting results
-    for file, local_dir, process in tex_processes:
-        print(f"Collecting {file.with_suffix('.pdf').name}")
-        process.wait()
+    if failures:
+        print(f"{len(failures)} of {total} reports failed:")
+        for name, failure in failures.items():
+            print(f"--- {name}: {failure}")
+        warn(f"{len(failures)} pdfs were not generated...")
+    return failures
 
-        out_file = (local_dir / file.name).with_suffix('.pdf')
-        if not out_file.exists():
-            warn(f"{out_file.name} was not generated...")
-        else:
-            copyfile(out_file, out_dir / out_file.name)
+
+# - stage caching
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+CACHE_INPUTS = ["siminfo.json", "final.yml", "stats.json", "results.csv",
+                SCRIPT_DIR / "teststub.tex.stub"]
+CACHE_SETUP = ["TEX_JOBS", "TEX_TIMEOUT", "TEX_PRECOMPILE", "TEX_BATCH", "TEX_NEW_DATE"]
+
+
+def get_output_pdfs(work_dir: Path) -> List[Path]:
+    # a pdf for every student, a missing one makes the stage run
+    _, students, _ = get_infos(work_dir)
+    return [Path("texs") / "output" / f"{slugify(student)}.pdf" for student in students]
+
+
+CACHE_OUTPUTS = get_output_pdfs
+
+
+def get_date_fingerprint(work_dir: Path):
+    # the evaluation date alone does not make a new build, unless
+    # TEX_NEW_DATE is set
+    if get_setup(work_dir).get("TEX_NEW_DATE", False):
+        return {"date": get_evaluation_date()}
+    return {}
+
+
+@cached_stage("mktexs", CACHE_INPUTS, CACHE_SETUP, CACHE_OUTPUTS, get_date_fingerprint)
+def stage(work_dir: Path, force=False, setup=None, info=None, stats=None, results=None, **state):
+    if setup is None:
+        setup = get_setup(work_dir)
+    with section("mktexs.render"):
+        changed, hashes = maketexs(work_dir, SCRIPT_DIR, info, stats, results,
+                                   setup.get("TEX_NEW_DATE", False))
+    preamble = get_static_preamble(
+        compile_template(get_tex_stub(SCRIPT_DIR)))
+    # forcing rebuilds all the reports
+    with section("mktexs.tex"):
+        failures = runtex(work_dir, preamble=preamble,
+                          changed=None if force else changed, **setup)
+    # failed sources keep no hash and lose their pdf, so they count as
+    # changed and the stage as stale at the next run
+    save_source_hashes(work_dir / "texs", {
+        name: digest for name, digest in hashes.items() if name not in failures})
+    return {}
 
 
-def main(argv):
-    maketexs(argv)
-    runtex(Path(argv[1]))
+def main(argv, force=False):
+    stage(Path(argv[1]), force)
 
 
 if __name__ == "__main__":
     import sys
-    main(sys.argv)
+    main([arg for arg in sys.argv if arg != "--force"],
+         force="--force" in sys.argv)
@@ -1,11 +1,19 @@
 #!/bin/env python3
 
+from concurrent.futures import ProcessPoolExecutor
 import csv
+from functools import partial
 import json
 from pathlib import Path
 from typing import List
+from warnings import warn
 import numpy as np
-from numpy.random import default_rng
+from numpy.lib.format import open_memmap
+from numpy.random import default_rng, SeedSequence
+
+from cache import cached_stage
+from profiling import section, timed
+from stats import TRACE_NAMES, Accumulator, gelman_rubin, get_log, softplus
 
 # ---            Programma di valutazione verifica:               ---
 # --- Estrazione MonteCarlo delle difficoltà e delle preparazioni ---
@@ -13,133 +21,775 @@ from numpy.random import default_rng
 # - results scanning
 
 
+def parse_cells(cells, shape):
+    # whole matrix at once, as bytes (much faster to convert than str). Cell
+    # by cell only to find the malformed ones, marked with -1
+    try:
+        return np.array(cells, dtype=bytes).reshape(shape).astype(int)
+    except ValueError:
+        values = np.full(shape, -1)
+        for i, row in enumerate(cells):
+            for j, cell in enumerate(row):
+                try:
+                    values[i, j] = int(cell)
+                except ValueError:
+                    pass
+        return values
+
+
 def get_results(inp_dir: Path):
     with open(inp_dir / "siminfo.json") as inp:
         data = json.load(inp)
     questions: List[str] = data["questions"]
     students: List[str] = data["students"]
 
-    results = np.zeros((len(students), len(questions)), dtype=int)
+    student_index = {student: i for i, student in enumerate(students)}
+    question_index = {question: j for j, question in enumerate(questions)}
+
+    # every problem is collected, to be reported at once
+    errors = []
     with open(inp_dir / "results.csv") as inp:
         reader = csv.reader(inp)
-        # skip first line
+        # first line: the questions
         header = next(reader)
-        # read others
+        columns = []
+        for j, question in enumerate(header[1:], start=1):
+            if question.strip() not in question_index:
+                errors.append(
+                    f"line 1, item {j+1}: unknown question {question.strip()!r}")
+            columns.append(question_index.get(question.strip(), -1))
+        # others: a student each
+        rows, line_nums, cells = [], [], []
         for line in reader:
-            student = line[0]
-            for j, res in enumerate(line[1:], start=1):
-                try:
-                    results[students.index(student.strip()), questions.index(
-                        header[j].strip())] = 2*int(res) - 1
-                except Exception as e:
-                    raise ValueError(
-                        f"Error while parsing {str(inp_dir)!r}, line {reader.line_num}, item {j+1}") from e
-
-    if np.any(results**2 != 1):
-        raise ValueError("Results are not complete")
+            student = line[0].strip()
+            if student not in student_index:
+                errors.append(
+                    f"line {reader.line_num}: unknown student {student!r}")
+            elif len(line) != len(header):
+                errors.append(
+                    f"line {reader.line_num}: {len(line)} items, expected {len(header)}")
+            else:
+                rows.append(student_index[student])
+                line_nums.append(reader.line_num)
+                cells.append(line[1:])
+
+    values = parse_cells(cells, (len(rows), len(columns)))
+    for i, j in zip(*np.nonzero((values != 0) & (values != 1))):
+        errors.append(
+            f"line {line_nums[i]}, item {j+2}: {cells[i][j]!r} is not 0 or 1")
+
+    for student in sorted(set(student_index.values()) - set(rows)):
+        errors.append(f"missing results of student {students[student]!r}")
+    for question in sorted(set(question_index.values()) - set(columns)):
+        errors.append(f"missing results of question {questions[question]!r}")
+
+    if errors:
+        raise ValueError(
+            f"Error while parsing {str(inp_dir / 'results.csv')!r}:\n    " + "\n    ".join(errors))
 
+    results = np.zeros((len(students), len(questions)), dtype=int)
+    results[np.ix_(rows, columns)] = 2*values - 1
     return results
 
 
+def get_names(inp_dir: Path):
+    with open(inp_dir / "siminfo.json") as inp:
+        data = json.load(inp)
+    return data["students"], data["questions"]
+
+
 def get_setup(inp_dir: Path):
     with open(inp_dir / "simsetup.json") as inp:
         return json.load(inp)
 
 # - weight function
 
+# each result contributes a factor 2/(1 + exp(alpha * r * (d - p))) to the
+# weight. The product underflows on big classes, so the sampler works on its
+# logarithm, a sum of log(2) - softplus(alpha * r * (d - p)) terms.
+
 
-def get_g(results):
-    def g(alpha, ds, ps):
-        dss, pss = np.meshgrid(ds, ps)
-        return np.prod(2/(1 + np.exp(alpha * results * (dss - pss))))
-    return g
+def get_log_g(results):
+    log_norm = results.size * np.log(2)
+
+    def log_g(alpha, ds, ps):
+        return log_norm - softplus(alpha * results * (ds[np.newaxis, :] - ps[:, np.newaxis])).sum()
+    return timed("montecarlo.weight", log_g)
 
 # - MonteCarlo random walk
 
 
-def montecarlo(results, SEED, DELTA, ALPHADELTA, THERM_LEN, SIM_LEN, **kwargs):
-    # use metropolis algorithm
-    ds_log = []
-    ps_log = []
-    alpha_log = []
+def bound(x):
+    # bring the proposals back in [0, 1]
+    mask = x > 1
+    x[mask] = 2-x[mask]
+    mask = x < 0
+    x[mask] = -x[mask]
+    return x
 
-    ds = np.full(results.shape[1], 0.5)
-    ps = np.full(results.shape[0], 0.5)
-    alpha = 0
 
-    accepted = 0
+# the walks read the proposal steps for difficulties, preparations and alpha
+# from `deltas`, so that they can be tuned while walking. Every step yields
+# the accepted and proposed moves of each of the three blocks
 
-    rng = default_rng(SEED)
 
-    g = get_g(results)
+def global_walk(results, rng, ds, ps, alpha, deltas):
+    # every step moves all the parameters together
+    log_g = get_log_g(results)
 
-    oldg = g(alpha, ds, ps)
+    old_log_g = log_g(alpha, ds, ps)
 
-    for i in range(THERM_LEN + SIM_LEN):
+    while True:
         # slightly change the state
-        nds = ds + DELTA * (2*rng.random(ds.shape)-1)
-        nps = ps + DELTA * (2*rng.random(ps.shape)-1)
-        nalpha = alpha + ALPHADELTA * (2*rng.random()-1)
-
-        # asure bounds
-        mask = nds > 1
-        nds[mask] = 1-nds[mask]
-        mask = nds < 0
-        nds[mask] = -nds[mask]
-        mask = nps > 1
-        nps[mask] = 1-nps[mask]
-        mask = nps < 0
-        nps[mask] = -nps[mask]
-        nalpha = np.abs(nalpha)
+        nds = bound(ds + deltas[0] * (2*rng.random(ds.shape)-1))
+        nps = bound(ps + deltas[1] * (2*rng.random(ps.shape)-1))
+        nalpha = np.abs(alpha + deltas[2] * (2*rng.random()-1))
 
         # calculate new weight
-        newg = g(nalpha, nds, nps)
+        new_log_g = log_g(nalpha, nds, nps)
 
         # reject step
-        if newg > oldg or oldg * rng.random() < newg:
+        accepted = 0
+        if new_log_g > old_log_g or np.log(rng.random()) < new_log_g - old_log_g:
             # accepted
             ds = nds
             ps = nps
             alpha = nalpha
-            oldg = newg
+            old_log_g = new_log_g
+
+            accepted = 1
+
+        yield ds, ps, alpha, (accepted,)*3, (1,)*3
+
+
+def sweep_walk(results, rng, ds, ps, alpha, deltas, students=None, questions=None):
+    # every step is a sweep moving one question, one student or alpha at a time.
+    # Only the column (or row) of the moved parameter enters the weight change.
+    # students and questions restrict the sweep to some rows and columns
+    log_g = get_log_g(results)
+
+    if questions is None:
+        questions = range(ds.shape[0])
+    if students is None:
+        students = range(ps.shape[0])
+
+    while True:
+        ds = ds.copy()
+        ps = ps.copy()
+        accepted = np.zeros(3, dtype=int)
+
+        # difficulties, one column at a time
+        nds = bound(ds + deltas[0] * (2*rng.random(ds.shape)-1))
+        log_us = np.log(rng.random(ds.shape))
+        for j in questions:
+            column = alpha * results[:, j]
+            delta = softplus(column * (ds[j] - ps)).sum() - \
+                softplus(column * (nds[j] - ps)).sum()
+            if delta > 0 or log_us[j] < delta:
+                ds[j] = nds[j]
+                accepted[0] += 1
+
+        # preparations, one row at a time
+        nps = bound(ps + deltas[1] * (2*rng.random(ps.shape)-1))
+        log_us = np.log(rng.random(ps.shape))
+        for i in students:
+            row = alpha * results[i, :]
+            delta = softplus(row * (ds - ps[i])).sum() - \
+                softplus(row * (ds - nps[i])).sum()
+            if delta > 0 or log_us[i] < delta:
+                ps[i] = nps[i]
+                accepted[1] += 1
+
+        # alpha touches the whole matrix
+        nalpha = np.abs(alpha + deltas[2] * (2*rng.random()-1))
+        delta = log_g(nalpha, ds, ps) - log_g(alpha, ds, ps)
+        if delta > 0 or np.log(rng.random()) < delta:
+            alpha = nalpha
+            accepted[2] += 1
 
-            accepted += 1
+        yield ds, ps, alpha, accepted, (len(questions), len(students), 1)
 
-        # log the data
-        if i >= THERM_LEN:
-            ds_log.append(ds)
-            ps_log.append(ps)
-            alpha_log.append(alpha)
 
-    ds_log = np.array(ds_log)
-    ps_log = np.array(ps_log)
-    alpha_log = np.array(alpha_log)
+# batched walk: CHAINS independent global walks, kept along a leading axis
+# and advanced together. Random numbers are drawn RANDOM_BLOCK steps at a time
 
-    accept_ratio = accepted / SIM_LEN
+RANDOM_BLOCK = 256
 
-    return ds_log, ps_log, alpha_log, accept_ratio
 
-# -- saving data
+def get_batched_log_g(results):
+    log_norm = results.size * np.log(2)
 
+    def log_g(alpha, ds, ps):
+        return log_norm - softplus(
+            alpha[:, np.newaxis, np.newaxis] * results
+            * (ds[:, np.newaxis, :] - ps[:, :, np.newaxis])
+        ).sum(axis=(1, 2))
+    return timed("montecarlo.weight", log_g)
 
-def save(out_dir, ds_log, ps_log, alpha_log, accept_ratio):
-    with open(out_dir / "montecarlo.npz", "wb") as out:
-        np.savez(
-            out,
-            ds_log=ds_log,
-            ps_log=ps_log,
-            alpha_log=alpha_log,
-            accept_ratio=accept_ratio
+
+def batched_walk(results, rng, ds, ps, alpha, deltas):
+    log_g = get_batched_log_g(results)
+
+    old_log_g = log_g(alpha, ds, ps)
+
+    while True:
+        # random numbers for the next block of steps
+        ds_steps = 2*rng.random((RANDOM_BLOCK, *ds.shape))-1
+        ps_steps = 2*rng.random((RANDOM_BLOCK, *ps.shape))-1
+        alpha_steps = 2*rng.random((RANDOM_BLOCK, *alpha.shape))-1
+        log_us = np.log(rng.random((RANDOM_BLOCK, *alpha.shape)))
+
+        for ds_step, ps_step, alpha_step, log_u in zip(ds_steps, ps_steps, alpha_steps, log_us):
+            # slightly change the state
+            nds = bound(ds + deltas[0] * ds_step)
+            nps = bound(ps + deltas[1] * ps_step)
+            nalpha = np.abs(alpha + deltas[2] * alpha_step)
+
+            # calculate new weight
+            new_log_g = log_g(nalpha, nds, nps)
+
+            # reject steps, chain by chain
+            accepted = (new_log_g > old_log_g) | (log_u < new_log_g - old_log_g)
+            ds = np.where(accepted[:, np.newaxis], nds, ds)
+            ps = np.where(accepted[:, np.newaxis], nps, ps)
+            alpha = np.where(accepted, nalpha, alpha)
+            old_log_g = np.where(accepted, new_log_g, old_log_g)
+
+            yield ds, ps, alpha, (accepted.sum(),)*3, (accepted.shape[0],)*3
+
+
+# hamiltonian walk: leapfrog trajectories guided by the gradient of the
+# log-weight, bouncing elastically on the borders of [0, 1] and on alpha = 0.
+# deltas are the leapfrog steps of each block (a diagonal mass matrix)
+
+LEAPFROG_STEPS = 10
+
+
+def get_log_g_and_grad(results):
+    log_norm = results.size * np.log(2)
+
+    def log_g_and_grad(alpha, ds, ps):
+        diffs = ds[np.newaxis, :] - ps[:, np.newaxis]
+        zs = alpha * results * diffs
+        # derivative of softplus(z), the logistic function
+        weights = 0.5 * (1 + np.tanh(zs / 2)) * results
+        return (
+            log_norm - softplus(zs).sum(),
+            -alpha * weights.sum(axis=0),
+            alpha * weights.sum(axis=1),
+            -(weights * diffs).sum()
         )
+    return timed("montecarlo.weight", log_g_and_grad)
+
+
+def reflect(x, momentum):
+    # fold x back in [0, 1], reversing the momentum at every bounce
+    bounces = np.floor(x)
+    x = x - bounces
+    odd = bounces % 2 != 0
+    x[odd] = 1 - x[odd]
+    momentum = np.where(odd, -momentum, momentum)
+    return x, momentum
+
+
+def hmc_walk(results, rng, ds, ps, alpha, deltas):
+    log_g_and_grad = get_log_g_and_grad(results)
+
+    old_log_g, *old_grads = log_g_and_grad(alpha, ds, ps)
+
+    while True:
+        momenta = [rng.standard_normal(ds.shape),
+                   rng.standard_normal(ps.shape),
+                   rng.standard_normal()]
+        old_energy = -old_log_g + sum(np.sum(m**2) for m in momenta) / 2
+
+        nds, nps, nalpha = ds, ps, alpha
+        grads = old_grads
+
+        # leapfrog integration
+        momenta = [m + delta / 2 * grad
+                   for m, delta, grad in zip(momenta, deltas, grads)]
+        for step in range(LEAPFROG_STEPS):
+            nds, momenta[0] = reflect(nds + deltas[0] * momenta[0], momenta[0])
+            nps, momenta[1] = reflect(nps + deltas[1] * momenta[1], momenta[1])
+            nalpha = nalpha + deltas[2] * momenta[2]
+            if nalpha < 0:
+                nalpha, momenta[2] = -nalpha, -momenta[2]
+
+            new_log_g, *grads = log_g_and_grad(nalpha, nds, nps)
+
+            # half kick on the last step
+            kick = 0.5 if step == LEAPFROG_STEPS - 1 else 1
+            momenta = [m + kick * delta * grad
+                       for m, delta, grad in zip(momenta, deltas, grads)]
+
+        new_energy = -new_log_g + sum(np.sum(m**2) for m in momenta) / 2
+
+        # reject trajectory
+        accepted = 0
+        if new_energy < old_energy or np.log(rng.random()) < old_energy - new_energy:
+            # accepted
+            ds = nds
+            ps = nps
+            alpha = nalpha
+            old_log_g = new_log_g
+            old_grads = grads
+
+            accepted = 1
+
+        yield ds, ps, alpha, (accepted,)*3, (1,)*3
+
+
+SAMPLERS = {
+    "global": global_walk,
+    "sweep": sweep_walk,
+    "hmc": hmc_walk,
+}
+
+
+# - trace storage
+
+# the trace can be stored with less precision, see TRACE_DTYPES, and
+# thinned keeping one step every THIN. The samples are cast when logged
+
+TRACE_DTYPES = ("float64", "float32", "float16")
+
+
+def allocate_trace(rows, n_students, n_questions, trace_dir=None, dtype="float64"):
+    # the trace is kept in memory, or in .npy files mapped from trace_dir
+    shapes = {
+        "ds_log": (rows, n_questions),
+        "ps_log": (rows, n_students),
+        "alpha_log": (rows,),
+    }
+    if trace_dir is None:
+        return tuple(np.empty(shapes[name], dtype=dtype) for name in TRACE_NAMES)
+    trace_dir.mkdir(exist_ok=True)
+    return tuple(
+        open_memmap(trace_dir / f"{name}.npy", mode="w+",
+                    dtype=dtype, shape=shapes[name])
+        for name in TRACE_NAMES
+    )
+
+
+def open_trace(trace_dir, rows):
+    # reopen a slice of a trace allocated by another process
+    return tuple(
+        open_memmap(trace_dir / f"{name}.npy", mode="r+")[rows]
+        for name in TRACE_NAMES
+    )
+
+# - proposal tuning
+
+# during the thermalization the steps are nudged toward TARGET_ACCEPT every
+# ADAPT_WINDOW steps, then they are frozen for the sampling
+
+ADAPT_WINDOW = 50
+
+# optimal acceptances for a many-dimensional and a one-dimensional proposal,
+# and for a hamiltonian trajectory
+TARGET_ACCEPTS = {
+    "global": 0.234,
+    "sweep": 0.44,
+    "batched": 0.234,
+    "hmc": 0.65,
+}
+
+# below this the chain is as good as frozen
+LOW_ACCEPT = 0.01
+
+
+def get_tuner(deltas, TARGET_ACCEPT):
+    # Robbins-Monro on the log of the steps, one block at a time
+    accepted = np.zeros(3)
+    proposed = np.zeros(3)
+    steps = 0
+    windows = 0
+
+    def tune(step_accepted, step_proposed):
+        nonlocal steps, windows
+        accepted[:] += step_accepted
+        proposed[:] += step_proposed
+        steps += 1
+        if steps % ADAPT_WINDOW:
+            return
+        windows += 1
+        deltas[:] *= np.exp((accepted / proposed -
+                            TARGET_ACCEPT) / np.sqrt(windows))
+        # bound reflects only once, bigger steps could leave [0, 1]
+        deltas[:2] = np.minimum(deltas[:2], 1)
+        accepted[:] = 0
+        proposed[:] = 0
+    return tune
+
+# - running moments
+
+
+def new_accumulators(chains, n_students, n_questions):
+    # one for each half of the chains, as split R-hat wants them
+    return {
+        "ds": (Accumulator(chains, n_questions), Accumulator(chains, n_questions)),
+        "ps": (Accumulator(chains, n_students), Accumulator(chains, n_students)),
+    }
+
+
+def pack_moments(groups):
+    # moments of the half chains, chain after chain
+    moments = {}
+    for name in ("ds", "ps"):
+        counts, means, m2s = [], [], []
+        for group in groups:
+            first, second = group[name]
+            first.flush()
+            second.flush()
+            chains = first.mean.shape[0]
+            counts.append(np.tile([first.count, second.count], chains))
+            means.append(np.stack([first.mean, second.mean], axis=1)
+                         .reshape(2*chains, -1))
+            m2s.append(np.stack([first.m2, second.m2], axis=1)
+                       .reshape(2*chains, *first.m2.shape[1:]))
+        moments[f"{name}_moments_count"] = np.concatenate(counts)
+        moments[f"{name}_moments_mean"] = np.concatenate(means)
+        moments[f"{name}_moments_m2"] = np.concatenate(m2s)
+    return moments
+
+# - warm start
+
+# after a correction of results.csv the chains restart from the last state of
+# the previous run, with its tuned steps. Only the students and questions whose
+# results changed are far from equilibrium: they are swept alone for
+# RETHERM_LEN steps, then the sampling starts without thermalization
+
+
+def get_warm_start(inp_dir: Path, results, SAMPLER, CHAINS):
+    # last state of every chain of the previous run, and the changed rows and
+    # columns. None if the previous run cannot be continued
+    if not (inp_dir / "montecarlo.npz").exists():
+        print("warm start: no previous run, starting cold")
+        return None, None
+    with open(inp_dir / "montecarlo.npz", "rb") as inp:
+        data = np.load(inp)
+        if "results" not in data or "deltas" not in data \
+                or data["results"].shape != results.shape or int(data["chains"]) != CHAINS \
+                or str(data["sampler"]) != SAMPLER \
+                or (list(data["students"]), list(data["questions"])) != tuple(get_names(inp_dir)):
+            print("warm start: previous run does not match, starting cold")
+            return None, None
+        old_results = data["results"]
+        deltas = data["deltas"]
+
+    # last row of each chain, chains are stored one after the other
+    ds_log, ps_log, alpha_log = (get_log(inp_dir, name) for name in TRACE_NAMES)
+    sim_len = alpha_log.shape[0] // CHAINS
+    last = slice(sim_len - 1, None, sim_len)
+    starts = list(zip(np.array(ds_log[last], dtype=float), np.array(ps_log[last], dtype=float),
+                      np.array(alpha_log[last], dtype=float), deltas))
+
+    changes = old_results != results
+    changed = np.flatnonzero(changes.any(axis=1)), np.flatnonzero(changes.any(axis=0))
+    print(f"warm start: {len(changed[0])} students and {len(changed[1])} questions changed")
+    return starts, changed
+
+
+def rethermalize(results, rng, ds, ps, alpha, deltas, changed, RETHERM_LEN):
+    students, questions = changed
+    if len(students) == 0 and len(questions) == 0:
+        return ds, ps, alpha
+    walk = sweep_walk(results, rng, ds, ps, alpha, deltas, students, questions)
+    for _, (ds, ps, alpha, *_) in zip(range(RETHERM_LEN), walk):
+        pass
+    return ds, ps, alpha
+
+# - running the chains
+
+
+def walk_and_log(walk, logs, THERM_LEN, SIM_LEN, tune=None, accumulators=None, THIN=1):
+    ds_log, ps_log, alpha_log = logs
+    rows = SIM_LEN // THIN
+
+    accepted = np.zeros(3)
+    proposed = np.zeros(3)
+
+    step = timed("montecarlo.step", walk.__next__)
+    for i in range(THERM_LEN + SIM_LEN):
+        ds, ps, alpha, step_accepted, step_proposed = step()
+        if i < THERM_LEN:
+            if tune is not None:
+                tune(step_accepted, step_proposed)
+            continue
+
+        # log the data, the last step of every THIN
+        sample = i - THERM_LEN
+        if sample % THIN == THIN - 1 and sample < rows * THIN:
+            ds_log[sample // THIN] = ds
+            ps_log[sample // THIN] = ps
+            alpha_log[sample // THIN] = alpha
+
+        if accumulators is not None:
+            half = i - THERM_LEN >= SIM_LEN // 2
+            accumulators["ds"][half].push(ds)
+            accumulators["ps"][half].push(ps)
+
+        accepted += step_accepted
+        proposed += step_proposed
 
+    return accepted.sum() / proposed.sum()
 
-def main(work_dir):
-    results = get_results(work_dir)
-    setup = get_setup(work_dir)
-    arrays = montecarlo(results, **setup)
-    save(work_dir, *arrays)
+
+def run_chain(results, seed, DELTA, ALPHADELTA, THERM_LEN, SIM_LEN, SAMPLER, ADAPT, TARGET_ACCEPT, ACCUMULATE,
+              logs=None, start=None, changed=None, RETHERM_LEN=0, THIN=1, TRACE_DTYPE="float64"):
+    # use metropolis algorithm
+    if logs is None:
+        logs = allocate_trace(SIM_LEN // THIN, *results.shape,
+                              dtype=TRACE_DTYPE)
+
+    rng = default_rng(seed)
+
+    if start is None:
+        ds = np.full(results.shape[1], 0.5)
+        ps = np.full(results.shape[0], 0.5)
+        alpha = 0
+
+        deltas = np.array([DELTA, DELTA, ALPHADELTA], dtype=float)
+        tune = get_tuner(deltas, TARGET_ACCEPT) if ADAPT else None
+    else:
+        ds, ps, alpha, deltas = start
+        deltas = np.array(deltas, dtype=float)
+        ds, ps, alpha = rethermalize(
+            results, rng, ds.copy(), ps.copy(), float(alpha), deltas, changed, RETHERM_LEN)
+        THERM_LEN = 0
+        tune = None
+
+    walk = SAMPLERS[SAMPLER](results, rng, ds, ps, alpha, deltas)
+
+    accumulators = new_accumulators(1, *results.shape) if ACCUMULATE else None
+
+    accept_ratio = walk_and_log(
+        walk, logs, THERM_LEN, SIM_LEN, tune, accumulators, THIN)
+
+    return (*logs, accept_ratio, deltas, accumulators)
+
+
+def run_chain_from(results, seed, start, **kwargs):
+    # executor.map passes the arguments of each chain by position
+    return run_chain(results, seed, start=start, **kwargs)
+
+
+def run_chain_on_disk(results, seed, chain, start, trace_dir, SIM_LEN, THIN, **kwargs):
+    # worker side: the samples go straight in the shared trace files
+    rows = SIM_LEN // THIN
+    logs = open_trace(trace_dir, slice(chain*rows, (chain+1)*rows))
+    *logs, accept_ratio, deltas, accumulators = run_chain(
+        results, seed, SIM_LEN=SIM_LEN, THIN=THIN, logs=logs, start=start, **kwargs)
+    for log in logs:
+        log.flush()
+    return accept_ratio, deltas, accumulators
+
+
+def run_batched(results, seed, DELTA, ALPHADELTA, THERM_LEN, SIM_LEN, CHAINS, ADAPT, TARGET_ACCEPT, ACCUMULATE,
+                logs, starts=None, changed=None, RETHERM_LEN=0, THIN=1, TRACE_DTYPE="float64"):
+    rng = default_rng(seed)
+
+    if starts is None:
+        ds = np.full((CHAINS, results.shape[1]), 0.5)
+        ps = np.full((CHAINS, results.shape[0]), 0.5)
+        alpha = np.zeros(CHAINS)
+
+        # one set of steps, tuned on the acceptance of all the chains
+        deltas = np.array([DELTA, DELTA, ALPHADELTA], dtype=float)
+        tune = get_tuner(deltas, TARGET_ACCEPT) if ADAPT else None
+    else:
+        ds, ps, alpha, deltas = (np.array(x, dtype=float) for x in zip(*starts))
+        deltas = deltas[0]
+        # the changed rows and columns are swept chain by chain
+        for chain in range(CHAINS):
+            ds[chain], ps[chain], alpha[chain] = rethermalize(
+                results, rng, ds[chain].copy(), ps[chain].copy(), alpha[chain], deltas, changed, RETHERM_LEN)
+        THERM_LEN = 0
+        tune = None
+
+    walk = batched_walk(results, rng, ds, ps, alpha, deltas)
+
+    # chains are stored one after the other
+    step_logs = tuple(
+        log.reshape(CHAINS, SIM_LEN // THIN, *log.shape[1:]).swapaxes(0, 1) for log in logs)
+
+    accumulators = new_accumulators(
+        CHAINS, *results.shape) if ACCUMULATE else None
+
+    accept_ratio = walk_and_log(
+        walk, step_logs, THERM_LEN, SIM_LEN, tune, accumulators, THIN)
+
+    return (*logs, accept_ratio, np.tile(deltas, (CHAINS, 1)), accumulators)
+
+
+def montecarlo(results, SEED, DELTA, ALPHADELTA, THERM_LEN, SIM_LEN, SAMPLER="global", CHAINS=1, WORKERS=None,
+               ADAPT=False, TARGET_ACCEPT=None, ACCUMULATE=False, RETHERM_LEN=200, THIN=1, TRACE_DTYPE="float64",
+               trace_dir=None, starts=None, changed=None, **kwargs):
+    # starts and changed come from get_warm_start, to continue a previous run
+    if SAMPLER not in SAMPLERS and SAMPLER != "batched":
+        raise ValueError(
+            f"Unknown SAMPLER {SAMPLER!r}, expected one of {', '.join(SAMPLERS)} or batched")
+    if TRACE_DTYPE not in TRACE_DTYPES:
+        raise ValueError(
+            f"Unknown TRACE_DTYPE {TRACE_DTYPE!r}, expected one of {', '.join(TRACE_DTYPES)}")
+    if THIN < 1 or SIM_LEN // THIN < 2:
+        raise ValueError(
+            f"THIN={THIN} leaves less than two samples of SIM_LEN={SIM_LEN}")
+    rows = SIM_LEN // THIN
+
+    if TARGET_ACCEPT is None:
+        TARGET_ACCEPT = TARGET_ACCEPTS[SAMPLER]
+    if SAMPLER == "hmc" and not ADAPT:
+        # DELTA is sized as a proposal, as a leapfrog step it gets almost
+        # every trajectory rejected
+        warn("The hmc sampler needs tuned leapfrog steps, turning ADAPT on")
+        ADAPT = True
+
+    chain_args = dict(DELTA=DELTA, ALPHADELTA=ALPHADELTA, THERM_LEN=THERM_LEN, SIM_LEN=SIM_LEN,
+                      ADAPT=ADAPT, TARGET_ACCEPT=TARGET_ACCEPT, ACCUMULATE=ACCUMULATE,
+                      changed=changed, RETHERM_LEN=RETHERM_LEN, THIN=THIN)
+
+    if SAMPLER == "batched":
+        # all the chains in a single process
+        logs = allocate_trace(CHAINS * rows, *results.shape,
+                              trace_dir, TRACE_DTYPE)
+        *logs, accept_ratio, deltas, accumulators = run_batched(
+            results, SEED, CHAINS=CHAINS, logs=logs, starts=starts, **chain_args)
+        return (*logs, accept_ratio, CHAINS, deltas,
+                pack_moments([accumulators]) if ACCUMULATE else None)
+
+    chain_args["SAMPLER"] = SAMPLER
+    if starts is None:
+        starts = [None] * CHAINS
+
+    if CHAINS == 1:
+        logs = allocate_trace(rows, *results.shape, trace_dir, TRACE_DTYPE)
+        *logs, accept_ratio, deltas, accumulators = run_chain(
+            results, SEED, logs=logs, start=starts[0], **chain_args)
+        return (*logs, accept_ratio, 1, deltas[np.newaxis],
+                pack_moments([accumulators]) if ACCUMULATE else None)
+
+    # independent streams, one for each chain
+    seeds = SeedSequence(SEED).spawn(CHAINS)
+
+    if trace_dir is not None:
+        logs = allocate_trace(CHAINS * rows, *results.shape,
+                              trace_dir, TRACE_DTYPE)
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            accept_ratios, deltas, accumulators = zip(*executor.map(
+                partial(run_chain_on_disk, results,
+                        trace_dir=trace_dir, **chain_args),
+                seeds, range(CHAINS), starts))
+        return (*logs, float(np.mean(accept_ratios)), CHAINS, np.array(deltas),
+                pack_moments(accumulators) if ACCUMULATE else None)
+
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+        ds_logs, ps_logs, alpha_logs, accept_ratios, deltas, accumulators = zip(
+            *executor.map(partial(run_chain_from, results, TRACE_DTYPE=TRACE_DTYPE, **chain_args),
+                          seeds, starts))
+
+    # chains are stored one after the other
+    return (
+        np.concatenate(ds_logs),
+        np.concatenate(ps_logs),
+        np.concatenate(alpha_logs),
+        float(np.mean(accept_ratios)),
+        CHAINS,
+        np.array(deltas),
+        pack_moments(accumulators) if ACCUMULATE else None
+    )
+
+# -- diagnostics
+
+
+def print_rhats(ds_log, ps_log, alpha_log, chains, RHAT_WARN_THRESHOLD=1.01, **kwargs):
+    print("R-hat (split chains):")
+    for name, log in (("difficulties", ds_log), ("scores", ps_log)):
+        rhats = gelman_rubin(log, chains)
+        worse = np.nanargmax(rhats)
+        print(f"    {name}: max {rhats[worse]:.4f} (#{worse})"
+              + "".join(f"\n        #{i}: {rhat:.4f}"
+                        for i, rhat in enumerate(rhats) if rhat > RHAT_WARN_THRESHOLD))
+    print(f"    alpha: {gelman_rubin(alpha_log, chains):.4f}")
+
+# -- saving data
+
+
+def get_trace(ds_log, ps_log, alpha_log, accept_ratio, chains=1, deltas=None, moments=None):
+    # everything montecarlo.npz holds, by name
+    trace = dict(
+        ds_log=ds_log,
+        ps_log=ps_log,
+        alpha_log=alpha_log,
+        accept_ratio=accept_ratio,
+        chains=chains
+    )
+    if deltas is not None:
+        # proposal steps used for the sampling, one row for each chain
+        trace["deltas"] = deltas
+    if moments is not None:
+        # running moments of difficulties and scores, see stats.Accumulator
+        trace.update(moments)
+    return trace
+
+
+def save(out_dir, trace, COMPRESS=False):
+    data = dict(trace)
+    if isinstance(trace["ds_log"], np.memmap):
+        # the trace is already on disk, only the metadata goes in the .npz
+        for name in TRACE_NAMES:
+            data.pop(name).flush()
+    with open(out_dir / "montecarlo.npz", "wb") as out:
+        (np.savez_compressed if COMPRESS else np.savez)(out, **data)
+
+
+# -- stage caching
+
+CACHE_INPUTS = ["siminfo.json", "results.csv"]
+CACHE_SETUP = ["SEED", "SAMPLER", "CHAINS", "DELTA", "ALPHADELTA", "ADAPT", "TARGET_ACCEPT",
+               "THERM_LEN", "SIM_LEN", "TRACE", "ACCUMULATE", "WARM_START", "RETHERM_LEN",
+               "THIN", "TRACE_DTYPE", "COMPRESS"]
+CACHE_OUTPUTS = ["montecarlo.npz"]
+
+
+@cached_stage("montecarlo", CACHE_INPUTS, CACHE_SETUP, CACHE_OUTPUTS)
+def stage(work_dir: Path, force=False, setup=None, results=None, **state):
+    if results is None:
+        with section("montecarlo.results"):
+            results = get_results(work_dir)
+    if setup is None:
+        setup = get_setup(work_dir)
+    starts, changed = None, None
+    if setup.get("WARM_START"):
+        # read before the new trace overwrites the old one
+        with section("montecarlo.warm_start"):
+            starts, changed = get_warm_start(
+                work_dir, results, setup.get("SAMPLER", "global"), setup.get("CHAINS", 1))
+    trace_dir = work_dir / "montecarlo" if setup.get("TRACE") == "memmap" else None
+    with section("montecarlo.sampling"):
+        arrays = montecarlo(results, **setup, trace_dir=trace_dir,
+                            starts=starts, changed=changed)
+    if arrays[3] < LOW_ACCEPT:
+        warn(f"Accept ratio {arrays[3]:.2%}, the chains barely moved: "
+             "try smaller DELTA and ALPHADELTA, or ADAPT")
+    with section("montecarlo.rhat"):
+        print_rhats(*arrays[:3], arrays[4], **setup)
+    with section("montecarlo.save"):
+        trace = get_trace(*arrays)
+        # kept to find what changed at the next warm start. The tuned steps are
+        # good only for the same sampler
+        students, questions = get_names(work_dir)
+        trace.update(results=results, students=np.array(students),
+                     questions=np.array(questions), sampler=setup.get("SAMPLER", "global"))
+        save(work_dir, trace, setup.get("COMPRESS", False))
+    return {"results": results, "trace": trace}
+
+
+def main(work_dir, force=False):
+    stage(work_dir, force)
 
 
 if __name__ == "__main__":
     import sys
-    main(Path(sys.argv[1]))
+    main(Path(sys.argv[1]), force="--force" in sys.argv[2:])
@@ -0,0 +1,84 @@
+#!/bin/env python3
+
+from importlib import import_module
+import json
+from pathlib import Path
+from sys import stderr
+
+import profiling
+
+# --- Programma di valutazione verifica: ---
+# ---   Esecuzione di più passi insieme   ---
+
+# every stage module exposes stage(work_dir, force, **state): it takes what
+# the previous stages left in memory, falling back to the files in work_dir,
+# and returns what it produced. Files are still written, as durable outputs.
+# With --profile the stages and their steps are timed, see profiling.py
+
+STAGES = ["montecarlo", "stats", "gamma", "report", "finalize", "mktexs"]
+
+# - arg checking
+
+
+FLAGS = {"--force", "--profile"}
+
+
+def check_args(argv):
+    args = [arg for arg in argv[1:] if arg not in FLAGS]
+    if not 1 <= len(args) <= 3 or any(stage not in STAGES for stage in args[1:]):
+        print(
+            f"Usage: {argv[0]} WORKDIR [FIRST [LAST]] [--force] [--profile]\n"
+            f"Stages: {', '.join(STAGES)}",
+            file=stderr
+        )
+        exit(1)
+
+
+def get_stages(argv):
+    args = [arg for arg in argv[1:] if arg not in FLAGS]
+    first = args[1] if len(args) > 1 else STAGES[0]
+    last = args[2] if len(args) > 2 else (first if len(args) > 1 else STAGES[-1])
+    return STAGES[STAGES.index(first):STAGES.index(last)+1]
+
+# - load data
+
+
+def get_setup(inp_dir: Path):
+    with open(inp_dir / "simsetup.json") as inp:
+        return json.load(inp)
+
+
+def get_info(inp_dir: Path):
+    with open(inp_dir / "siminfo.json") as inp:
+        return json.load(inp)
+
+# - running
+
+
+def run(work_dir: Path, stages, force=False):
+    state = {
+        "setup": get_setup(work_dir),
+        "info": get_info(work_dir),
+    }
+    try:
+        for name in stages:
+            print(f"--- {name} ---")
+            with profiling.stage(name):
+                # imported only now, so that the quick stages do not load numpy
+                stage = import_module(name).stage
+                state.update(stage(work_dir, force=force, **state))
+    finally:
+        profiling.save(work_dir)
+
+
+def main(argv):
+    check_args(argv)
+    work_dir = Path([arg for arg in argv[1:] if arg not in FLAGS][0])
+    if "--profile" in argv:
+        profiling.enable()
+    run(work_dir, get_stages(argv), force="--force" in argv)
+
+
+if __name__ == "__main__":
+    import sys
+    main(sys.argv)
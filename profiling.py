@@ -0,0 +1,101 @@
+from contextlib import contextmanager
+from functools import wraps
+import json
+from pathlib import Path
+import resource
+from threading import Lock
+from time import perf_counter
+import tracemalloc
+
+# --- Programma di valutazione verifica: ---
+# ---      Misura dei tempi dei passi     ---
+
+# sections are named "stage.step". Their calls and total seconds are summed,
+# also across threads (the TeX jobs), so a section can last more than its
+# stage. Sections run in the worker processes of montecarlo are lost.
+# Stages also record the peak of the memory traced by tracemalloc, which
+# numpy reports to as well. When profiling is not enabled nothing is measured
+
+PROFILE = "profile.json"
+
+enabled = False
+timings = {}
+peaks = {}
+lock = Lock()
+
+
+def enable():
+    global enabled
+    enabled = True
+    tracemalloc.start()
+
+
+def add(name, seconds):
+    with lock:
+        timing = timings.setdefault(name, {"calls": 0, "seconds": 0.})
+        timing["calls"] += 1
+        timing["seconds"] += seconds
+
+
+@contextmanager
+def section(name):
+    if not enabled:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        add(name, perf_counter() - start)
+
+
+def timed(name, function):
+    # function itself when not profiling, so that hot loops pay nothing
+    if not enabled:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            add(name, perf_counter() - start)
+    return wrapper
+
+
+@contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+    tracemalloc.reset_peak()
+    try:
+        with section(name):
+            yield
+    finally:
+        peaks[name] = max(peaks.get(name, 0),
+                          tracemalloc.get_traced_memory()[1])
+
+
+def print_profile():
+    name_len = max((len(name) for name in timings), default=0)
+    print("Profile:")
+    for name, timing in timings.items():
+        print(f"    {name.ljust(name_len)}: {timing['seconds']:9.3f} s"
+              f" in {timing['calls']} calls"
+              + (f", peak {peaks[name] / 2**20:.1f} MiB" if name in peaks else ""))
+
+
+def save(work_dir: Path):
+    if not enabled:
+        return
+    print_profile()
+    with open(work_dir / PROFILE, "w") as out:
+        json.dump({
+            "sections": timings,
+            # bytes
+            "peak_traced_memory": peaks,
+            "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "children_max_rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        }, out, indent=2)
@@ -6,6 +6,8 @@ from pathlib import Path
 import yaml
 import json
 
+from cache import cached_stage
+
 # --- Programma di valutazione verifica: ---
 # ---          Report testuale           ---
 
@@ -37,11 +39,12 @@ def get_comments(inp_dir: Path):
         return yaml.load(inp, Loader=yaml.SafeLoader)
 
 
-def get_data(inp_dir: Path):
+def get_data(inp_dir: Path, setup=None, stats=None, info=None):
+    # setup, stats and info are read from inp_dir, unless already in memory
     return {
-        "setup": get_setup(inp_dir),
-        "stats": get_stats(inp_dir),
-        "info": get_info(inp_dir),
+        "setup": get_setup(inp_dir) if setup is None else setup,
+        "stats": get_stats(inp_dir) if stats is None else stats,
+        "info": get_info(inp_dir) if info is None else info,
         "votes": get_votes(inp_dir),
         "comments": get_comments(inp_dir)
     }
@@ -84,6 +87,45 @@ def make_corrs_table(corr_data, names, CORRS_WARN_THRESHOLD):
     )
 
 
+def make_deltas_line(stats):
+    if "proposal_deltas" not in stats:
+        return "not available"
+    d_delta, p_delta, alpha_delta = stats["proposal_deltas"]
+    return f"difficulties {d_delta:.3}, scores {p_delta:.3}, alpha {alpha_delta:.3}"
+
+
+def make_rhat_table(stats, students, questions, RHAT_WARN_THRESHOLD):
+    if "alpha_rhat" not in stats:
+        return "    not available"
+    lines = []
+    for group, names in (("scores", students), ("difficulties", questions)):
+        rhats = stats[f"{group}_rhat"]
+        lines.append(f"    {group}: max {max(rhats):.4f}")
+        lines.extend(
+            f"        ({name}: {rhat:.4f})"
+            for name, rhat in zip(names, rhats) if rhat > RHAT_WARN_THRESHOLD
+        )
+    lines.append(f"    alpha: {stats['alpha_rhat']:.4f}")
+    return "\n".join(lines)
+
+
+def make_ess_table(stats, students, questions, ESS_WORST):
+    if "alpha_ess" not in stats:
+        return "    not available"
+    params = [
+        *zip(students, stats["scores_ess"], stats["scores_autocorr_time"]),
+        *zip(questions, stats["difficulties_ess"],
+             stats["difficulties_autocorr_time"]),
+        ("alpha", stats["alpha_ess"], stats["alpha_autocorr_time"]),
+    ]
+    params.sort(key=lambda param: param[1])
+    name_len = max(len(name) for name, _, _ in params)
+    return "\n".join(
+        f"    {name.ljust(name_len)}: {ess:8.0f} (tau {tau:.1f})"
+        for name, ess, tau in params[:ESS_WORST]
+    )
+
+
 REPORT_FMT = """Result report for "{test_name}":
 Test given to class {test_class} on {test_date}.
 Arguments:
@@ -108,14 +150,24 @@ Difficulty correlations (marked outlier of more than {CORRS_WARN_THRESHOLD} sigm
 Technical data:
     Setup used:
         SEED={SEED}
+        SAMPLER={sampler}
 
         DELTA={DELTA}
         ALPHADELTA={ALPHADELTA}
         THERM_LEN={THERM_LEN}
         SIM_LEN={SIM_LEN}
+        THIN={thin}
+        TRACE_DTYPE={trace_dtype}
 
+    Proposal steps: {proposal_deltas}
     Accept ratio: {accept_ratio:.0%}
-    Alpha: {alpha_mean:.2f} +- {alpha_std:.2}"""
+    Alpha: {alpha_mean:.2f} +- {alpha_std:.2}
+
+    R-hat (marked above {rhat_warn_threshold}):
+{rhat_table}
+
+    Lowest effective sample sizes:
+{ess_table}"""
 
 
 def get_report(data):
@@ -153,9 +205,25 @@ def get_report(data):
             data["setup"]["CORRS_WARN_THRESHOLD"]),
 
         ** data["setup"],
+        sampler=data["setup"].get("SAMPLER", "global"),
+        thin=data["setup"].get("THIN", 1),
+        trace_dtype=data["setup"].get("TRACE_DTYPE", "float64"),
+        proposal_deltas=make_deltas_line(data["stats"]),
         accept_ratio=data["stats"]["accept_ratio"],
         alpha_mean=data["stats"]["alpha"][0],
         alpha_std=data["stats"]["alpha"][1],
+
+        rhat_warn_threshold=data["setup"].get("RHAT_WARN_THRESHOLD", 1.01),
+        rhat_table=make_rhat_table(
+            data["stats"],
+            data["info"]["students"],
+            data["info"]["questions"],
+            data["setup"].get("RHAT_WARN_THRESHOLD", 1.01)),
+        ess_table=make_ess_table(
+            data["stats"],
+            data["info"]["students"],
+            data["info"]["questions"],
+            data["setup"].get("ESS_WORST", 5)),
     )
 
 
@@ -164,10 +232,24 @@ def save(out_dir: Path, report: str):
         out.write(report)
 
 
-def main(work_dir: Path):
-    save(work_dir, get_report(get_data(work_dir)))
+# - stage caching
+
+CACHE_INPUTS = ["stats.json", "siminfo.json", "votes.json", "comments.yml"]
+CACHE_SETUP = ["SEED", "SAMPLER", "DELTA", "ALPHADELTA", "THERM_LEN", "SIM_LEN",
+               "THIN", "TRACE_DTYPE", "CORRS_WARN_THRESHOLD", "RHAT_WARN_THRESHOLD", "ESS_WORST"]
+CACHE_OUTPUTS = ["report.txt"]
+
+
+@cached_stage("report", CACHE_INPUTS, CACHE_SETUP, CACHE_OUTPUTS)
+def stage(work_dir: Path, force=False, setup=None, stats=None, info=None, **state):
+    save(work_dir, get_report(get_data(work_dir, setup, stats, info)))
+    return {}
+
+
+def main(work_dir: Path, force=False):
+    stage(work_dir, force)
 
 
 if __name__ == "__main__":
     import sys
-    main(Path(sys.argv[1]))
+    main(Path(sys.argv[1]), force="--force" in sys.argv[2:])
@@ -1,19 +1,38 @@
 #!/bin/env python3
 
+from functools import partial
 import json
 from pathlib import Path
 import numpy as np
 
+from cache import cached_stage
+from profiling import section
+
 # --- Programma di valutazione verifica: ---
 # ---         Analisi dei dati           ---
 
 # -- loading data
 
 
-def get_arrays(inp_dir: Path):
+# in the order montecarlo returns the logs
+TRACE_NAMES = ("ds_log", "ps_log", "alpha_log")
+
+
+def get_log(inp_dir: Path, name: str):
+    # from the .npz or mapped from its .npy, in the stored dtype: the readers
+    # upcast one chunk at a time, see as_float
+    with open(inp_dir / "montecarlo.npz", "rb") as inp:
+        data = np.load(inp)
+        if name in data:
+            return data[name]
+    # the trace was streamed to disk, map it lazily
+    return np.load(inp_dir / "montecarlo" / f"{name}.npy", mmap_mode="r")
+
+
+def get_metadata(inp_dir: Path):
     with open(inp_dir / "montecarlo.npz", "rb") as inp:
         data = np.load(inp)
-        return data["ps_log"], data["ds_log"],  data["alpha_log"], float(data["accept_ratio"])
+        return {key: data[key] for key in data if key not in TRACE_NAMES}
 
 
 def get_perfect_scorer_pts(inp_dir: Path):
@@ -23,59 +42,293 @@ def get_perfect_scorer_pts(inp_dir: Path):
 
 # -- data analysis
 
+# the trace can be bigger than memory, so long computations walk it in
+# blocks of CHUNK_ROWS samples
+
+CHUNK_ROWS = 4096
+
+
+def as_float(chunk):
+    # traces can be stored as float32 or float16, computations are in float64
+    return np.asarray(chunk, dtype=float)
+
+
+def iter_chunks(log):
+    for start in range(0, log.shape[0], CHUNK_ROWS):
+        yield as_float(log[start:start+CHUNK_ROWS])
+
+
 # means and stdev
 def mean_and_std(log):
-    return np.mean(log, axis=0), np.std(log, axis=0)
+    mean = sum(chunk.sum(axis=0) for chunk in iter_chunks(log)) / log.shape[0]
+    var = sum(((chunk - mean)**2).sum(axis=0)
+              for chunk in iter_chunks(log)) / log.shape[0]
+    return mean, np.sqrt(var)
 
 # perfect and worse scorer data
 
+# the probability of a perfect (worse) scorer having preparation p is the
+# weight of all right (wrong) answers, summed over the trace. It is built in
+# log space, a block of samples at a time, for both of them at once
 
-def get_extremal_score(extreme: int, ds_log, alpha_log, PERFECT_SCORER_PTS):
-    ps_lin = np.linspace(0, 1, PERFECT_SCORER_PTS)
 
-    Pps = np.ones((PERFECT_SCORER_PTS, ds_log.shape[0]))
-    for i in range(ds_log.shape[1]):
-        dss, pss = np.meshgrid(ds_log[:, i], ps_lin)
-        Pps *= (2/(1 + np.exp(extreme * alpha_log * (dss - pss))))
-    Pps = Pps.sum(axis=1)
-    Pps /= Pps.sum()
+def softplus(x):
+    # log(1 + exp(x)), stable for large |x|. Much faster than
+    # np.logaddexp(0, x), and the samplers call it at every step
+    return np.maximum(x, 0) + np.log1p(np.exp(-np.abs(x)))
 
-    mean = (Pps*ps_lin).sum()
-    std = np.sqrt((Pps*(ps_lin**2)).sum() - mean**2)
 
+def logsumexp(x, axis):
+    x_max = np.max(x, axis=axis, keepdims=True)
+    return np.squeeze(x_max, axis) + np.log(np.sum(np.exp(x - x_max), axis=axis))
+
+
+def weighted_mean_and_std(log_weights, values):
+    weights = np.exp(log_weights - log_weights.max())
+    weights /= weights.sum()
+    mean = (weights*values).sum()
+    std = np.sqrt((weights*(values**2)).sum() - mean**2)
     return mean, std
 
 
+def get_extremal_scores(ds_log, alpha_log, PERFECT_SCORER_PTS):
+    ps_lin = np.linspace(0, 1, PERFECT_SCORER_PTS)
+
+    # the log(2) of every factor cancels in the normalization
+    log_perf = np.full(PERFECT_SCORER_PTS, -np.inf)
+    log_worse = np.full(PERFECT_SCORER_PTS, -np.inf)
+    for start in range(0, ds_log.shape[0], CHUNK_ROWS):
+        ds_chunk = as_float(ds_log[start:start+CHUNK_ROWS])
+        alpha_chunk = as_float(alpha_log[start:start+CHUNK_ROWS])
+
+        chunk_perf = np.zeros((PERFECT_SCORER_PTS, ds_chunk.shape[0]))
+        chunk_worse = np.zeros((PERFECT_SCORER_PTS, ds_chunk.shape[0]))
+        for ds in ds_chunk.T:
+            zs = alpha_chunk * (ds - ps_lin[:, np.newaxis])
+            log_factors = softplus(zs)
+            chunk_perf -= log_factors
+            # softplus(-z) = softplus(z) - z
+            chunk_worse -= log_factors - zs
+
+        log_perf = np.logaddexp(log_perf, logsumexp(chunk_perf, axis=1))
+        log_worse = np.logaddexp(log_worse, logsumexp(chunk_worse, axis=1))
+
+    return (
+        weighted_mean_and_std(log_perf, ps_lin),
+        weighted_mean_and_std(log_worse, ps_lin)
+    )
+
+
+# convergence
+
+def rhat_from_moments(counts, means, variances):
+    # counts, means and (biased) variances of the half chains
+    n = np.mean(counts)
+    within = np.mean(variances * (counts / (counts - 1))[:, np.newaxis], axis=0)
+    between = n * np.var(means, axis=0, ddof=1)
+    var_plus = (n - 1) / n * within + between / n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sqrt(var_plus / within)
+
+
+def gelman_rubin(log, chains):
+    # split R-hat: every chain is cut in two halves, so that a single chain
+    # gets checked for drifts too
+    n = log.shape[0] // chains // 2
+    halves = [
+        chain[half*n:(half+1)*n]
+        for chain in log.reshape(chains, -1, *log.shape[1:])
+        for half in range(2)
+    ]
+
+    means, stds = zip(*(mean_and_std(half) for half in halves))
+    means = np.reshape(means, (2*chains, -1))
+    variances = np.reshape(np.square(stds), (2*chains, -1))
+    rhats = rhat_from_moments(np.full(2*chains, n), means, variances)
+    return rhats.reshape(log.shape[1:])
+
+
+# autocorrelation
+
+# the integrated autocorrelation time is summed up to the first lag M with
+# M >= AUTOCORR_WINDOW * tau(M) (Sokal). The trace is read AUTOCORR_COLUMNS
+# parameters at a time
+
+AUTOCORR_WINDOW = 5
+AUTOCORR_COLUMNS = 64
+
+
+def autocorr(chunk):
+    # normalized autocorrelation of every column, through the FFT
+    n = chunk.shape[0]
+    centered = chunk - chunk.mean(axis=0)
+    size = 2 ** int(np.ceil(np.log2(2*n)))
+    transform = np.fft.rfft(centered, n=size, axis=0)
+    acov = np.fft.irfft(transform.real**2 + transform.imag**2,
+                        n=size, axis=0)[:n]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return acov / acov[0]
+
+
+def integrated_time(rhos):
+    taus = 2*np.cumsum(rhos, axis=0) - 1
+    window = np.arange(rhos.shape[0])[:, np.newaxis] >= AUTOCORR_WINDOW * taus
+    lags = np.where(window.any(axis=0), window.argmax(axis=0),
+                    rhos.shape[0] - 1)
+    return taus[lags, np.arange(rhos.shape[1])]
+
+
+def autocorr_times(log, chains):
+    # autocorrelations are averaged over the chains
+    columns = log.reshape(log.shape[0], -1)
+    n = log.shape[0] // chains
+    taus = np.empty(columns.shape[1])
+    for start in range(0, columns.shape[1], AUTOCORR_COLUMNS):
+        block = slice(start, start + AUTOCORR_COLUMNS)
+        rhos = sum(
+            autocorr(as_float(columns[chain*n:(chain+1)*n, block]))
+            for chain in range(chains)
+        ) / chains
+        taus[block] = integrated_time(rhos)
+    return taus.reshape(log.shape[1:])
+
+
 # correlations
 
+def corrs_stats(corrs):
+    corr_list = corrs[np.triu_indices(corrs.shape[0], 1)]
+    return corrs, np.mean(corr_list), np.std(corr_list)
+
+
 def get_corrs(log, log_means):
-    corrs = np.empty((log.shape[1],)*2)
-    for i in range(log.shape[1]):
-        for j in range(i+1, log.shape[1]):
-            corrs[i, j] = np.mean(log[:, i] * log[:, j]) - \
-                log_means[i] * log_means[j]
-    p_corr_list = [corrs[i, j]
-                   for i in range(log.shape[1])
-                   for j in range(i+1, log.shape[1])]
-    return corrs, np.mean(p_corr_list), np.std(p_corr_list)
-
-
-def do_stats(inp_dir):
-    ps_log, ds_log,  alpha_log, accept_ratio = get_arrays(inp_dir)
-    PERFECT_SCORER_PTS = get_perfect_scorer_pts(inp_dir)
-
-    p_means, p_stds = mean_and_std(ps_log)
-    d_means, d_stds = mean_and_std(ds_log)
+    # covariance matrix, accumulated one block of samples at a time
+    corrs = np.zeros((log.shape[1],)*2)
+    for chunk in iter_chunks(log):
+        centered = chunk - log_means
+        corrs += centered.T @ centered
+    corrs /= log.shape[0]
+    return corrs_stats(corrs)
+
+
+# running moments of every step, in full precision even when the trace is
+# thinned or stored as float16. They only replace the passes over the trace
+# for means, correlations and R-hat: the trace is still read for the
+# autocorrelation times and the extremal scores. Samples are buffered and
+# merged ACCUMULATE_BLOCK at a time with the pairwise update of Chan et al.
+
+ACCUMULATE_BLOCK = 256
+
+
+class Accumulator:
+    def __init__(self, chains, size):
+        # one running mean and covariance for each chain
+        self.count = 0
+        self.mean = np.zeros((chains, size))
+        self.m2 = np.zeros((chains, size, size))
+
+        self.buffer = np.empty((ACCUMULATE_BLOCK, chains, size))
+        self.buffered = 0
+
+    def push(self, sample):
+        self.buffer[self.buffered] = np.reshape(sample, self.mean.shape)
+        self.buffered += 1
+        if self.buffered == ACCUMULATE_BLOCK:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        block = self.buffer[:self.buffered]
+        block_mean = block.mean(axis=0)
+        centered = (block - block_mean).transpose(1, 0, 2)
+        self.merge(self.buffered, block_mean,
+                   centered.transpose(0, 2, 1) @ centered)
+        self.buffered = 0
+
+    def merge(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + (self.count * count / total) * \
+            delta[:, :, np.newaxis] * delta[:, np.newaxis, :]
+        self.mean += delta * (count / total)
+        self.count = total
+
+
+def merge_moments(counts, means, m2s):
+    count = counts.sum()
+    mean = (counts[:, np.newaxis] * means).sum(axis=0) / count
+    deltas = means - mean
+    m2 = m2s.sum(axis=0) + \
+        (counts[:, np.newaxis] * deltas).T @ deltas
+    return count, mean, m2
+
+
+# summaries of a block of parameters: means, stds, correlations and R-hat
+
+def stats_from_trace(log, chains):
+    with section("stats.mean_and_std"):
+        means, stds = mean_and_std(log)
+    with section("stats.corrs"):
+        corrs = get_corrs(log, means)
+    with section("stats.rhat"):
+        rhats = gelman_rubin(log, chains)
+    return means, stds, corrs, rhats
+
+
+def stats_from_moments(counts, means, m2s):
+    # moments of the half chains, as saved by montecarlo
+    count, mean, m2 = merge_moments(counts, means, m2s)
+    covs = m2 / count
+    variances = np.diagonal(m2s, axis1=1, axis2=2) / counts[:, np.newaxis]
+    return (
+        mean,
+        np.sqrt(np.diagonal(covs)),
+        corrs_stats(covs),
+        rhat_from_moments(counts, means, variances)
+    )
+
+
+def get_block_stats(log_getter, metadata, name: str):
+    if f"{name}_moments_count" in metadata:
+        # accumulated by montecarlo over every step
+        return stats_from_moments(*(
+            metadata[f"{name}_moments_{moment}"] for moment in ("count", "mean", "m2")))
+    # older files hold a single chain
+    chains = int(metadata.get("chains", 1))
+    return stats_from_trace(log_getter(f"{name}_log"), chains)
+
+
+def do_stats(inp_dir, trace=None, setup=None):
+    # trace and setup are read from inp_dir, unless they are already in memory
+    if trace is None:
+        metadata = get_metadata(inp_dir)
+        log_getter = partial(get_log, inp_dir)
+    else:
+        metadata = trace
+        log_getter = trace.__getitem__
+    ds_log = log_getter("ds_log")
+    alpha_log = log_getter("alpha_log")
+    PERFECT_SCORER_PTS = get_perfect_scorer_pts(
+        inp_dir) if setup is None else setup["PERFECT_SCORER_PTS"]
+
+    p_means, p_stds, (p_corrs, p_corr_mean, p_corr_std), p_rhats = \
+        get_block_stats(log_getter, metadata, "ps")
+    d_means, d_stds, (d_corrs, d_corr_mean, d_corr_std), d_rhats = \
+        get_block_stats(log_getter, metadata, "ds")
     alpha_stat = mean_and_std(alpha_log)
 
-    perf_score = get_extremal_score(1, ds_log, alpha_log, PERFECT_SCORER_PTS)
-    worse_score = get_extremal_score(-1, ds_log, alpha_log, PERFECT_SCORER_PTS)
+    chains = int(metadata.get("chains", 1))
+    with section("stats.autocorr"):
+        p_taus = autocorr_times(log_getter("ps_log"), chains)
+        d_taus = autocorr_times(ds_log, chains)
+        alpha_tau = autocorr_times(alpha_log, chains)
 
-    p_corrs, p_corr_mean, p_corr_std = get_corrs(ps_log, p_means)
-    d_corrs, d_corr_mean, d_corr_std = get_corrs(ds_log, d_means)
+    with section("stats.extremal_scores"):
+        perf_score, worse_score = get_extremal_scores(
+            ds_log, alpha_log, PERFECT_SCORER_PTS)
 
-    return {
-        "accept_ratio": accept_ratio,
+    stat_data = {
+        "accept_ratio": float(metadata["accept_ratio"]),
 
         "scores": list(zip(p_means, p_stds)),
 
@@ -84,17 +337,33 @@ def do_stats(inp_dir):
 
         "scores_corrs": (
             [[p_corrs[j, i] for j in range(i)]
-             for i in range(ps_log.shape[1])],
+             for i in range(len(p_means))],
             p_corr_mean, p_corr_std),
 
         "difficulties": list(zip(d_means, d_stds)),
         "difficulties_corrs": (
             [[d_corrs[j, i] for j in range(i)]
-             for i in range(ds_log.shape[1])],
+             for i in range(len(d_means))],
             d_corr_mean, d_corr_std),
 
-        "alpha": alpha_stat
+        "alpha": alpha_stat,
+
+        "scores_rhat": list(p_rhats),
+        "difficulties_rhat": list(d_rhats),
+        "alpha_rhat": float(gelman_rubin(alpha_log, chains)),
+
+        # integrated autocorrelation times and effective sample sizes
+        "scores_autocorr_time": list(p_taus),
+        "scores_ess": list(ds_log.shape[0] / p_taus),
+        "difficulties_autocorr_time": list(d_taus),
+        "difficulties_ess": list(ds_log.shape[0] / d_taus),
+        "alpha_autocorr_time": float(alpha_tau),
+        "alpha_ess": float(ds_log.shape[0] / alpha_tau),
     }
+    if "deltas" in metadata:
+        # difficulties, scores and alpha steps, averaged over the chains
+        stat_data["proposal_deltas"] = list(metadata["deltas"].mean(axis=0))
+    return stat_data
 
 
 def save(out_dir, stat_data):
@@ -102,12 +371,27 @@ def save(out_dir, stat_data):
         json.dump(stat_data, out, indent=2)
 
 
-def main(argv):
-    work_dir = Path(argv[1])
-    stats = do_stats(work_dir)
-    save(work_dir, stats)
+# -- stage caching
+
+CACHE_INPUTS = ["montecarlo.npz"] + \
+    [f"montecarlo/{name}.npy" for name in TRACE_NAMES]
+CACHE_SETUP = ["PERFECT_SCORER_PTS"]
+CACHE_OUTPUTS = ["stats.json"]
+
+
+@cached_stage("stats", CACHE_INPUTS, CACHE_SETUP, CACHE_OUTPUTS)
+def stage(work_dir: Path, force=False, trace=None, setup=None, **state):
+    stats = do_stats(work_dir, trace, setup)
+    with section("stats.save"):
+        save(work_dir, stats)
+    return {"stats": stats}
+
+
+def main(argv, force=False):
+    stage(Path(argv[1]), force)
 
 
 if __name__ == "__main__":
     import sys
-    main(sys.argv)
+    main([arg for arg in sys.argv if arg != "--force"],
+         force="--force" in sys.argv)
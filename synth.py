@@ -0,0 +1,88 @@
+#!/bin/env python3
+
+import csv
+import json
+from pathlib import Path
+from sys import stderr
+import numpy as np
+from numpy.random import default_rng
+
+from init import create_dir
+
+# --- Programma di valutazione verifica: ---
+# ---   Generazione di verifiche fittizie  ---
+
+# the results are drawn from the model sampled by montecarlo: a student with
+# preparation p answers right a question with difficulty d with probability
+# 1 / (1 + exp(alpha * (d - p))). The drawn difficulties, preparations and
+# alpha are saved in truth.json, to compare them with what montecarlo finds
+
+ALPHA = 10
+
+METADATA = {
+    "name": "Synthetic exam",
+    "class": "0S",
+    "date": "01/01/2000",
+    "argument": "Generated by synth.py",
+    "description": "Results drawn from the model, see truth.json",
+}
+
+# - arg checking
+
+
+def check_args(argv):
+    if len(argv) not in {4, 5} or not all(arg.isdigit() for arg in argv[2:]):
+        print(f"Usage: {argv[0]} OUTPUTDIR STUDENTS QUESTIONS [SEED]", file=stderr)
+        exit(1)
+
+# - drawing
+
+
+def draw(n_students, n_questions, rng, alpha=ALPHA):
+    ds = rng.random(n_questions)
+    ps = rng.random(n_students)
+    right = 1 / (1 + np.exp(alpha * (ds[np.newaxis, :] - ps[:, np.newaxis])))
+    results = (rng.random(right.shape) < right).astype(int)
+    return ds, ps, results
+
+# - saving data
+
+
+def make_exam(output_dir: Path, n_students, n_questions, seed=0, alpha=ALPHA):
+    rng = default_rng(seed)
+    students = [f"Student {i:0{len(str(n_students))}}"
+                for i in range(1, n_students + 1)]
+    questions = [f"Question {j:0{len(str(n_questions))}}"
+                 for j in range(1, n_questions + 1)]
+    create_dir(output_dir, METADATA, students, questions)
+
+    ds, ps, results = draw(n_students, n_questions, rng, alpha)
+    with open(output_dir/"results.csv", "w") as out:
+        writer = csv.writer(out)
+        writer.writerow([METADATA["name"]] + questions)
+        writer.writerows([[name] + list(row)
+                         for name, row in zip(students, results.tolist())])
+    with open(output_dir/"truth.json", "w") as out:
+        json.dump(
+            {
+                "alpha": alpha,
+                "difficulties": list(ds),
+                "scores": list(ps),
+            },
+            out, indent=2
+        )
+
+
+def main(argv):
+    check_args(argv)
+    output_dir = Path(argv[1])
+    if output_dir.exists():
+        print(f"{output_dir} exist", file=stderr)
+        exit(1)
+    make_exam(output_dir, int(argv[2]), int(argv[3]),
+              int(argv[4]) if len(argv) == 5 else 0)
+
+
+if __name__ == "__main__":
+    import sys
+    main(sys.argv)